@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+"""
+Import-time budget for the keystroke path.
+
+Runs main.py with a query that has no prompt stop, which is what Flow
+Launcher sends while the user is still typing, under `python -X importtime`.
+Fails when one of the heavy modules is imported on that path, or when the
+total import time exceeds the budget.
+
+The plugin folder must be inside a Flow Launcher installation and the
+resident worker must not be running, otherwise the request is forwarded to it:
+
+    python benchmarks/import_budget.py --plugin-dir <plugin folder>
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+from typing import Dict, List, Optional
+
+# Modules that are only needed once a prompt is actually sent
+HEAVY_MODULES = (
+    "requests",
+    "urllib3",
+    "charset_normalizer",
+    "idna",
+    "certifi",
+    "pyperclip",
+    "sqlite3",
+    "csv",
+)
+
+TYPING_REQUEST = {"method": "query", "parameters": ["what is the"]}
+
+
+def measure(
+    plugin_dir: str, env: Optional[dict] = None, request: dict = TYPING_REQUEST
+) -> Dict[str, int]:
+    """
+    Cumulative import time in microseconds of every import made by main.py
+    for the request, leaving out the interpreter startup. Nested imports keep
+    their indentation.
+    """
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            os.path.join(plugin_dir, "main.py"),
+            json.dumps(request),
+        ],
+        cwd=plugin_dir,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"main.py failed:\n{result.stderr}")
+
+    imports = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        name = name[1:].rstrip()
+        if name == "site":
+            # Everything before this was imported while starting Python
+            imports = {}
+            continue
+        imports[name] = int(cumulative)
+    return imports
+
+
+def total_ms(imports: Dict[str, int]) -> float:
+    """
+    Total import time, counting every top-level import once.
+    """
+    return sum(us for name, us in imports.items() if not name.startswith(" ")) / 1000
+
+
+def check(imports: Dict[str, int], budget_ms: float) -> List[str]:
+    """
+    Problems found in the measured imports, if any.
+    """
+    problems = []
+    for name in imports:
+        module = name.strip()
+        if module.split(".")[0] in HEAVY_MODULES:
+            problems.append(f"{module} is imported on the typing path")
+
+    total = total_ms(imports)
+    if total > budget_ms:
+        problems.append(f"imports took {total:.1f}ms, budget is {budget_ms}ms")
+    return problems
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--plugin-dir",
+        default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    parser.add_argument("--budget-ms", type=float, default=150)
+    args = parser.parse_args()
+
+    imports = measure(args.plugin_dir)
+    slowest = sorted(
+        ((us, name) for name, us in imports.items() if not name.startswith(" ")),
+        reverse=True,
+    )
+    for us, name in slowest[:10]:
+        print(f"{us / 1000:8.1f}ms  {name}")
+
+    problems = check(imports, args.budget_ms)
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
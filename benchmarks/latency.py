@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end latency benchmark.
+
+Copies the plugin into a simulated Flow Launcher folder layout, points it at
+a local OpenAI-compatible stub server and runs main.py the way Flow Launcher
+does, with the JSON-RPC request as the first argument. For the typing,
+answer and action paths it reports:
+
+- cold start: wall time of the whole main.py process
+- imports: time spent importing modules, from `python -X importtime`
+- settings: creating the plugin, which loads the settings
+- prompts: loading system_messages.csv
+- request: handling the request, including the call to the stub
+- serialization: turning the results into the JSON-RPC response
+
+Results are written as JSON, so runs on different commits can be compared:
+
+    python benchmarks/latency.py --output before.json
+    python benchmarks/latency.py --output after.json --compare before.json
+
+The action path copies a short text to the clipboard.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import import_budget  # noqa: E402
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = {
+    "typing": {"method": "query", "parameters": ["what is the"]},
+    "answer": {"method": "query", "parameters": ["short what is the answer ||"]},
+    "action": {"method": "copy_answer", "parameters": ["benchmark"]},
+}
+
+# Runs inside the simulated plugin folder and times the phases of a request
+PROBE = """
+import sys, json, time
+request = json.loads(sys.argv[1])
+sys.path[:0] = ["", "lib", "plugin"]
+timings = {}
+start = time.perf_counter()
+from plugin import actions
+if actions.dispatch(request):
+    timings["request"] = time.perf_counter() - start
+else:
+    from plugin.main import ChatGPT
+
+    class Probe(ChatGPT):
+        def run(self, debug=None):
+            pass
+
+    start = time.perf_counter()
+    plugin = Probe()
+    timings["settings"] = time.perf_counter() - start
+    start = time.perf_counter()
+    plugin.engine.prompts
+    timings["prompts"] = time.perf_counter() - start
+    start = time.perf_counter()
+    results = getattr(plugin, request["method"])(*request["parameters"])
+    timings["request"] = time.perf_counter() - start
+    start = time.perf_counter()
+    json.dumps({"result": results or plugin._results})
+    timings["serialization"] = time.perf_counter() - start
+print(json.dumps({name: seconds * 1000 for name, seconds in timings.items()}))
+"""
+
+
+class StubServer:
+    """
+    OpenAI-compatible chat completions endpoint with a fixed latency and
+    answer size, optionally streaming the answer in chunks.
+    """
+
+    def __init__(self, latency: float, answer_size: int, chunks: int):
+        answer = ("lorem ipsum " * (answer_size // 12 + 1))[:answer_size]
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length))
+                time.sleep(server.latency)
+                if body.get("stream"):
+                    self.stream(answer)
+                else:
+                    self.reply(answer, body.get("n", 1))
+
+            def reply(self, answer: str, n: int):
+                data = json.dumps(
+                    {
+                        "choices": [
+                            {"index": i, "message": {"content": answer}}
+                            for i in range(n)
+                        ]
+                    }
+                ).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def stream(self, answer: str):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                size = max(len(answer) // server.chunks, 1)
+                for i in range(0, len(answer), size):
+                    delta = {"content": answer[i : i + size]}
+                    event = {"choices": [{"index": 0, "delta": delta}]}
+                    self.chunk(f"data: {json.dumps(event)}\n\n")
+                self.chunk("data: [DONE]\n\n")
+                self.chunk("")
+
+            def chunk(self, text: str):
+                data = text.encode("utf-8")
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+
+        self.latency = latency
+        self.chunks = chunks
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/v1/chat/completions"
+
+    def __enter__(self) -> "StubServer":
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeLauncher:
+    """
+    Temporary Flow Launcher folder layout with a copy of the plugin installed.
+    """
+
+    def __init__(self, settings: dict):
+        self.root = tempfile.mkdtemp(prefix="flow-chatgpt-bench-")
+        user_data = os.path.join(self.root, "FlowLauncher", "UserData")
+        self.plugin_dir = os.path.join(user_data, "Plugins", "ChatGPT")
+        shutil.copytree(
+            REPO_DIR,
+            self.plugin_dir,
+            ignore=shutil.ignore_patterns(
+                ".git", "__pycache__", "state", "Conversations *", "*.log"
+            ),
+        )
+
+        settings_dir = os.path.join(user_data, "Settings")
+        os.makedirs(os.path.join(settings_dir, "Plugins", "ChatGPT"))
+        with open(os.path.join(settings_dir, "Settings.json"), "w") as f:
+            json.dump({"PluginSettings": {"Plugins": {}}}, f)
+        with open(
+            os.path.join(settings_dir, "Plugins", "ChatGPT", "Settings.json"), "w"
+        ) as f:
+            json.dump(settings, f)
+
+        self.env = dict(os.environ)
+        self.env.setdefault("LOCALAPPDATA", os.path.join(self.root, "Local"))
+        self.env.setdefault("APPDATA", os.path.join(self.root, "Roaming"))
+
+    def run(self, request: dict) -> float:
+        """
+        Run main.py like Flow Launcher does and return the wall time in ms.
+        """
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "main.py", json.dumps(request)],
+            cwd=self.plugin_dir,
+            env=self.env,
+            capture_output=True,
+            text=True,
+        )
+        elapsed = (time.perf_counter() - start) * 1000
+        if result.returncode != 0:
+            raise RuntimeError(f"main.py failed:\n{result.stderr}")
+        return elapsed
+
+    def probe(self, request: dict) -> Dict[str, float]:
+        result = subprocess.run(
+            [sys.executable, "-c", PROBE, json.dumps(request)],
+            cwd=self.plugin_dir,
+            env=self.env,
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"Probe failed:\n{result.stderr}")
+        return json.loads(result.stdout.strip().splitlines()[-1])
+
+    def stop_worker(self) -> None:
+        try:
+            with open(os.path.join(self.plugin_dir, "state", "worker.json")) as f:
+                pid = json.load(f)["pid"]
+            os.kill(pid, 9)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def close(self) -> None:
+        self.stop_worker()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def benchmark(launcher: FakeLauncher, request: dict, repeat: int) -> Dict[str, float]:
+    """
+    Median of every metric over repeat runs.
+    """
+    samples: Dict[str, List[float]] = {}
+    for _ in range(repeat):
+        metrics = {"cold_start": launcher.run(request)}
+        imports = import_budget.measure(launcher.plugin_dir, launcher.env, request)
+        metrics["imports"] = import_budget.total_ms(imports)
+        metrics.update(launcher.probe(request))
+        for name, value in metrics.items():
+            samples.setdefault(name, []).append(value)
+    return {name: statistics.median(values) for name, values in samples.items()}
+
+
+def compare(results: dict, baseline: dict) -> None:
+    for scenario, metrics in results["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(scenario, {})
+        print(f"\n{scenario}")
+        for name, value in metrics.items():
+            line = f"  {name:<14}{value:9.1f}ms"
+            if name in before and before[name]:
+                change = (value - before[name]) / before[name] * 100
+                line += f"  (was {before[name]:.1f}ms, {change:+.0f}%)"
+            print(line)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds")
+    parser.add_argument("--answer-size", type=int, default=2000, help="characters")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--chunks", type=int, default=50)
+    parser.add_argument("--resident-worker", action="store_true")
+    parser.add_argument("--scenario", choices=SCENARIOS, action="append")
+    parser.add_argument("--output")
+    parser.add_argument("--compare")
+    args = parser.parse_args()
+
+    scenarios = args.scenario or list(SCENARIOS)
+    results = {
+        "options": {
+            "latency": args.latency,
+            "answer_size": args.answer_size,
+            "stream": args.stream,
+            "resident_worker": args.resident_worker,
+            "repeat": args.repeat,
+        },
+        "scenarios": {},
+    }
+
+    with StubServer(args.latency, args.answer_size, args.chunks) as stub:
+        launcher = FakeLauncher(
+            {
+                "api_key": "benchmark",
+                "model": "gpt-3.5-turbo",
+                "prompt_stop": "||",
+                "default_prompt": "normal",
+                "api_endpoint": stub.url,
+                "log_level": "error",
+                "stream": args.stream,
+                "cache_ttl": "0",
+                "save_conversation": False,
+                "resident_worker": args.resident_worker,
+            }
+        )
+        try:
+            if args.resident_worker:
+                launcher.run(SCENARIOS["typing"])
+                time.sleep(2)
+            for name in scenarios:
+                results["scenarios"][name] = benchmark(
+                    launcher, SCENARIOS[name], args.repeat
+                )
+        finally:
+            launcher.close()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    compare(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,14 +2,39 @@
 
 import sys
 import os
+import json
 
 parent_folder_path = os.path.abspath(os.path.dirname(__file__))
 sys.path.append(parent_folder_path)
 sys.path.append(os.path.join(parent_folder_path, "lib"))
 sys.path.append(os.path.join(parent_folder_path, "plugin"))
 
-from plugin.main import ChatGPT
+from plugin import actions, worker  # noqa: E402
 
 
 if __name__ == "__main__":
-    ChatGPT()
+    if sys.argv[1:] == ["--worker"]:
+        worker.serve()
+        sys.exit()
+
+    if sys.argv[1:] == ["--speculate"]:
+        from plugin.main import ChatGPT
+
+        ChatGPT(argv=json.dumps({"method": "speculate", "parameters": []}), output=[])
+        sys.exit()
+
+    if len(sys.argv) > 1:
+        request = sys.argv[1]
+    else:
+        request = json.dumps({"method": "query", "parameters": [""]})
+
+    if actions.dispatch(json.loads(request)):
+        sys.exit()
+
+    output = worker.forward(request)
+    if output is not None:
+        sys.stdout.buffer.write(output.encode("utf-8"))
+    else:
+        from plugin.main import ChatGPT
+
+        ChatGPT()
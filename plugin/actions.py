@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""
+JSON-RPC methods that Flow Launcher calls when a result is selected.
+
+Every action declares the state it needs. Actions that need nothing beyond
+the plugin folder are dispatched by main.py directly, without loading flox,
+the plugin settings or the system prompts.
+"""
+
+import os
+from typing import Callable, Dict, Optional, Tuple
+
+ACTIONS: Dict[str, Tuple[Callable, Tuple[str, ...]]] = {}
+
+LOG_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "plugin.log"
+)
+
+
+def action(needs: Tuple[str, ...] = ()) -> Callable:
+    """
+    Register a function as an action. needs lists the plugin state the action
+    depends on, such as "settings"; only actions without any can skip the
+    plugin setup.
+    """
+
+    def register(func: Callable) -> Callable:
+        ACTIONS[func.__name__] = (func, needs)
+        return func
+
+    return register
+
+
+def dispatch(request: dict) -> bool:
+    """
+    Run the requested action if it can run without the plugin setup. Returns
+    False when the request has to be handled by the full plugin instead. A
+    failing action is logged, and not run a second time by the plugin.
+    """
+    method = request.get("method")
+    if method not in ACTIONS:
+        return False
+    func, needs = ACTIONS[method]
+    if needs:
+        return False
+    # Actions log too, like a handle whose answer cannot be loaded
+    log_to_file()
+    try:
+        func(*request.get("parameters", []))
+    except Exception as e:
+        import logging
+
+        logging.exception(f"Action {method} failed: {e}")
+    return True
+
+
+def log_to_file() -> None:
+    """
+    Log to plugin.log the way flox does, for actions that run without it.
+    Flow shows anything written to stderr as an error of the plugin.
+    """
+    import logging
+    import logging.handlers
+
+    logger = logging.getLogger()
+    if logger.handlers:
+        return
+    handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE, maxBytes=1024 * 2024, backupCount=1
+    )
+    handler.setFormatter(
+        logging.Formatter(
+            "%(asctime)s %(levelname)s (%(filename)s): %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    logger.addHandler(handler)
+    logger.setLevel(logging.WARNING)
+
+
+@action()
+def copy_answer(answer: str) -> None:
+    """
+    Copy answer, or the stored answer it is a handle of, to the clipboard.
+    """
+    import pyperclip
+
+    from plugin import answers
+
+    answer = answers.resolve(answer)
+    if answer is not None:
+        pyperclip.copy(answer)
+
+
+@action()
+def open_in_editor(filename: Optional[str], answer: Optional[str]) -> None:
+    """
+    Open the answer in the default text editor. If no filename is given,
+    the answer, or the stored answer it is a handle of, will be written to a
+    new text file and opened.
+    """
+    import webbrowser
+
+    from plugin import answers
+    from plugin.conversation_log import ConversationLog
+
+    if filename:
+        webbrowser.open(ConversationLog(filename).render())
+        return
+
+    answer = answers.resolve(answer)
+    if answer:
+        temp_file = "temp_text.txt"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            f.write(answer)
+        webbrowser.open(temp_file)
+        return
+
+
+@action()
+def open_plugin_folder() -> None:
+    import webbrowser
+
+    webbrowser.open(os.getcwd())
+
+
+@action()
+def new_thread(keyword: str) -> None:
+    """
+    Forget the earlier turns that are sent as context for the keyword.
+    """
+    from plugin.threads import ThreadStore
+
+    ThreadStore(os.path.join("state", "threads")).clear(keyword)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""
+Content-addressed store for the answers shown in the results.
+
+Results carry a short handle instead of the answer itself, so the results
+JSON stays small and the command line Flow runs an action with does not
+grow with the answer. The actions resolve the handle back to the answer.
+Anything that is not a handle of a stored answer is used as the answer
+itself, so results from older versions keep working.
+"""
+
+import os
+import re
+import time
+import hashlib
+import logging
+from typing import Optional
+
+from plugin.locks import atomic_write
+
+DIRECTORY = os.path.join("state", "answers")
+PREFIX = "answer:"
+
+# Answers are removed when they were not shown for this long, checked hourly
+MAX_AGE = 7 * 24 * 60 * 60
+CLEAN_INTERVAL = 60 * 60
+
+_HANDLE = re.compile(rf"{PREFIX}([0-9a-f]{{32}})")
+
+
+def handle(answer: str) -> str:
+    return PREFIX + hashlib.sha256(answer.encode("utf-8")).hexdigest()[:32]
+
+
+def path(answer_handle: str, directory: str = DIRECTORY) -> Optional[str]:
+    match = _HANDLE.fullmatch(answer_handle or "")
+    if not match:
+        return None
+    return os.path.join(directory, f"{match.group(1)}.txt")
+
+
+def store(answer: str, directory: str = DIRECTORY) -> str:
+    """
+    Save the answer, unless it is already stored, and return its handle. When
+    it cannot be saved, the answer itself is returned.
+    """
+    answer_handle = handle(answer)
+    answer_path = path(answer_handle, directory)
+    try:
+        os.utime(answer_path)
+    except FileNotFoundError:
+        try:
+            with atomic_write(answer_path) as f:
+                f.write(answer)
+        except OSError as e:
+            logging.error(f"Unable to store the answer: {e}")
+            return answer
+    return answer_handle
+
+
+def resolve(value: Optional[str], directory: str = DIRECTORY) -> Optional[str]:
+    """
+    The answer a handle refers to, or None when it cannot be loaded. Other
+    values are returned as they are.
+    """
+    answer_path = path(value, directory)
+    if answer_path is None:
+        return value
+    try:
+        with open(answer_path, "r", encoding="utf-8", newline="") as f:
+            return f.read()
+    except OSError as e:
+        logging.error(f"Unable to load the answer for {value}: {e}")
+        return None
+
+
+def clean(directory: str = DIRECTORY) -> None:
+    """
+    Remove the answers that were not shown for MAX_AGE seconds, at most once
+    every CLEAN_INTERVAL seconds.
+    """
+    marker = os.path.join(directory, "cleaned")
+    now = time.time()
+    try:
+        if now - os.stat(marker).st_mtime < CLEAN_INTERVAL:
+            return
+    except FileNotFoundError:
+        pass
+    try:
+        with open(marker, "w"):
+            pass
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(".txt"):
+                    if now - entry.stat().st_mtime > MAX_AGE:
+                        os.remove(entry.path)
+    except OSError as e:
+        logging.warning(f"Unable to clean the stored answers: {e}")
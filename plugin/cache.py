@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+
+class ResponseCache:
+    """
+    On-disk cache of answers, keyed by a hash of the request that produced
+    them. Entries expire after ttl seconds and the least recently used ones are
+    evicted once the cache holds more than max_entries or max_bytes.
+    """
+
+    def __init__(self, path: str, ttl: int, max_entries: int, max_bytes: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(url: str, body: dict) -> str:
+        data = json.dumps([url, body], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            with self._connect() as db:
+                row = db.execute(
+                    "SELECT answer, created FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                answer, created = row
+                now = time.time()
+                if now - created > self.ttl:
+                    db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    return None
+                db.execute(
+                    "UPDATE responses SET accessed = ? WHERE key = ?", (now, key)
+                )
+                return answer
+        except sqlite3.Error as e:
+            logging.error(f"Unable to read from the response cache: {e}")
+            return None
+
+    def put(self, key: str, answer: str) -> None:
+        now = time.time()
+        size = len(answer.encode("utf-8"))
+        try:
+            with self._connect() as db:
+                db.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                    (key, answer, size, now, now),
+                )
+                db.execute(
+                    "DELETE FROM responses WHERE created < ?", (now - self.ttl,)
+                )
+                db.execute(
+                    """
+                    DELETE FROM responses WHERE key IN (
+                        SELECT key FROM (
+                            SELECT
+                                key,
+                                ROW_NUMBER() OVER (ORDER BY accessed DESC) AS n,
+                                SUM(size) OVER (ORDER BY accessed DESC) AS total
+                            FROM responses
+                        )
+                        WHERE n > ? OR total > ?
+                    )
+                    """,
+                    (self.max_entries, self.max_bytes),
+                )
+        except sqlite3.Error as e:
+            logging.error(f"Unable to write to the response cache: {e}")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=5)
+        try:
+            with db:
+                db.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS responses (
+                        key TEXT PRIMARY KEY,
+                        answer TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        created REAL NOT NULL,
+                        accessed REAL NOT NULL
+                    )
+                    """
+                )
+                yield db
+        finally:
+            db.close()
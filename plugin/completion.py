@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from typing import List, Optional
+
+
+@dataclass
+class Completion:
+    """
+    Answer returned by the API, with the timing of the request. error holds
+    the message of an error returned by the API, and timeout_phase what the
+    request was doing when it ran out of time. cancelled is set when a newer
+    query made the request stale, and hedged when a duplicate request sent
+    because the first one was slow answered first. length_limited is set
+    when an answer stopped at max_tokens. When several choices were asked
+    for, choices holds all of them and answer the first one.
+    """
+
+    answer: str
+    prompt_timestamp: datetime
+    answer_timestamp: datetime
+    first_token_timestamp: Optional[datetime] = None
+    tokens: int = 0
+    partial: bool = False
+    error: str = ""
+    timeout_phase: str = ""
+    cancelled: bool = False
+    hedged: bool = False
+    length_limited: bool = False
+    choices: List[str] = field(default_factory=list)
+
+    @property
+    def latency(self) -> float:
+        return (self.answer_timestamp - self.prompt_timestamp).total_seconds()
+
+    @property
+    def time_to_first_token(self) -> Optional[float]:
+        if self.first_token_timestamp is None:
+            return None
+        return (self.first_token_timestamp - self.prompt_timestamp).total_seconds()
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        if self.first_token_timestamp is None or self.tokens < 2:
+            return None
+        duration = (self.answer_timestamp - self.first_token_timestamp).total_seconds()
+        return (self.tokens - 1) / duration if duration > 0 else None
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        for name, value in data.items():
+            if isinstance(value, datetime):
+                data[name] = value.isoformat()
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Completion":
+        data = dict(data)
+        for name in ("prompt_timestamp", "answer_timestamp", "first_token_timestamp"):
+            if data.get(name):
+                data[name] = datetime.fromisoformat(data[name])
+        return cls(**data)
+
+    def describe(self) -> str:
+        description = f"{self.latency:.1f}s"
+        if self.time_to_first_token is not None:
+            description += f", first token after {self.time_to_first_token:.1f}s"
+        if self.tokens_per_second is not None:
+            description += f", {self.tokens_per_second:.0f} tokens/s"
+        return description
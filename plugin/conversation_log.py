@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import os
+import struct
+import logging
+from typing import Iterator, List, Tuple
+
+from plugin.locks import FileLock, atomic_write
+
+# Every index entry holds the offset and length of one record in the log
+INDEX_ENTRY = struct.Struct("<QQ")
+
+
+class ConversationLog:
+    """
+    Conversations for one keyword, stored as an append-only log with an
+    index of record offsets next to it.
+
+    Saving a turn appends one record, so it costs the same no matter how long
+    the history is. The text file that is opened in the editor is a view with
+    the newest turns first, rendered from the log when it is opened.
+    """
+
+    def __init__(self, view_path: str, fsync: bool = False):
+        base = os.path.splitext(view_path)[0]
+        self.view_path = view_path
+        self.log_path = f"{base}.log"
+        self.index_path = f"{base}.idx"
+        self.lock_path = f"{base}.lock"
+        self.fsync = fsync
+
+    def exists(self) -> bool:
+        return os.path.exists(self.log_path) or os.path.exists(self.view_path)
+
+    def append(self, text: str) -> None:
+        """
+        Append a record. A record that was only partly written by a crashed
+        process is discarded first, so the log and the index always agree.
+        """
+        with FileLock(self.lock_path):
+            if not os.path.exists(self.log_path) and os.path.exists(self.view_path):
+                self._import_view()
+            self._append(text.encode("utf-8"))
+
+    def records(self) -> Iterator[str]:
+        """
+        Records from newest to oldest.
+        """
+        entries = self._read_index()
+        if not entries:
+            return
+        with open(self.log_path, "rb") as log:
+            for offset, length in reversed(entries):
+                log.seek(offset)
+                yield log.read(length).decode("utf-8", errors="replace")
+
+    def render(self) -> str:
+        """
+        Write the view with the newest turns first and return its path. The
+        view is only rewritten when the log changed since it was rendered.
+        """
+        if not os.path.exists(self.log_path):
+            return self.view_path
+        try:
+            view_mtime = os.stat(self.view_path).st_mtime_ns
+            if view_mtime > os.stat(self.log_path).st_mtime_ns:
+                return self.view_path
+        except OSError:
+            pass
+
+        with FileLock(self.lock_path):
+            with atomic_write(self.view_path) as view:
+                for record in self.records():
+                    view.write(record)
+        return self.view_path
+
+    def _import_view(self) -> None:
+        """
+        Older versions kept the conversations in the view file, newest first.
+        Keep that history as the first record of the log.
+        """
+        try:
+            with open(self.view_path, "rb") as view:
+                content = view.read()
+        except OSError as e:
+            logging.error(f"Unable to import {self.view_path}: {e}")
+            return
+        if content:
+            self._append(content)
+
+    def _append(self, data: bytes) -> None:
+        entries = self._read_index(repair=True)
+        end = entries[-1][0] + entries[-1][1] if entries else 0
+
+        with open(self.log_path, "ab+") as log:
+            log.seek(0, os.SEEK_END)
+            size = log.tell()
+            if size > end:
+                logging.warning(
+                    f"Discarding {size - end} unindexed bytes at the end of "
+                    f"{self.log_path}"
+                )
+                log.truncate(end)
+            log.write(data)
+            self._sync(log)
+
+        with open(self.index_path, "ab") as index:
+            index.write(INDEX_ENTRY.pack(end, len(data)))
+            self._sync(index)
+
+    def _read_index(self, repair: bool = False) -> List[Tuple[int, int]]:
+        """
+        Entries of the index that point to records that were fully written.
+        With repair, which requires holding the lock, invalid trailing entries
+        are also removed from the index file.
+        """
+        try:
+            with open(self.index_path, "rb") as index:
+                data = index.read()
+            log_size = os.path.getsize(self.log_path)
+        except OSError:
+            return []
+
+        usable = len(data) - len(data) % INDEX_ENTRY.size
+        entries = list(INDEX_ENTRY.iter_unpack(data[:usable]))
+        while entries and sum(entries[-1]) > log_size:
+            entries.pop()
+        if repair and len(entries) * INDEX_ENTRY.size != len(data):
+            with open(self.index_path, "r+b") as index:
+                index.truncate(len(entries) * INDEX_ENTRY.size)
+        return entries
+
+    def _sync(self, file) -> None:
+        file.flush()
+        if self.fsync:
+            os.fsync(file.fileno())
@@ -0,0 +1,1111 @@
+# -*- coding: utf-8 -*-
+
+"""
+Launcher-independent prompt pipeline.
+
+Engine takes a query, resolves the system prompt, sends it to the API and
+saves the conversation. It has no dependency on flox or Flow Launcher, so it
+can be used headless, from scripts and from benchmarks. Storage and transport
+are passed in, and default to the plugin's own implementations.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime
+from functools import cached_property
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+from plugin import tokens
+from plugin.completion import Completion
+from plugin.conversation_log import ConversationLog
+from plugin.generation import Generation
+from plugin.hedging import HedgeStats, Race
+from plugin.models import ModelChoice, ModelRouter
+from plugin.prompts import PromptTable
+from plugin.ratelimit import RateLimiter
+from plugin.router import Endpoint, Router
+from plugin.threads import ThreadStore, Turn
+from plugin.writebehind import WriteBehind
+
+if TYPE_CHECKING:
+    import requests
+    from plugin.cache import ResponseCache
+    from plugin.transport import Abort, Transport
+
+PROXIES = {
+    "http": os.environ.get("HTTP_PROXY", ""),
+    "https": os.environ.get("HTTPS_PROXY", ""),
+}
+
+# Error statuses, besides 5xx, after which another endpoint may do better
+FAILOVER_STATUSES = (401, 403, 404, 408, 409, 429)
+
+
+@dataclass
+class EngineConfig:
+    """
+    Settings used by the engine. data_dir holds system_messages.csv, the
+    conversations and the state folder; empty means the working directory.
+    A context_limit of 0 uses the known limit of the model, and
+    context_overflow is "truncate" or "refuse". With thread_turns above 0,
+    up to that many earlier turns, within thread_tokens, are sent as context.
+    fallback_endpoints are used when api_endpoint fails or is slower. With
+    hedge_percentile above 0, a duplicate request is sent when the response
+    takes longer than that percentile of the recent response times.
+    model_by_size holds (tokens, model) rules for prompts up to that size,
+    and fast_model is used when the response time of the chosen model is
+    above fast_model_latency. With write_behind, the conversation, cache and
+    statistics are saved in the background; see Engine.write_behind.
+    """
+
+    api_key: str
+    model: str = "gpt-3.5-turbo"
+    api_endpoint: str = "https://api.openai.com/v1/chat/completions"
+    prompt_stop: str = "||"
+    default_system_prompt: str = "normal"
+    stream: bool = False
+    save_conversation: bool = False
+    fsync_conversation: bool = False
+    cache_ttl: int = 24 * 60 * 60
+    cache_max_entries: int = 500
+    cache_max_bytes: int = 20 * 1024 * 1024
+    cache_exclude: List[str] = field(default_factory=list)
+    pool_size: int = 4
+    prompt_separator: str = ""
+    max_parallel_requests: int = 4
+    max_retries: int = 3
+    requests_per_minute: int = 0
+    tokens_per_minute: int = 0
+    connect_timeout: float = 5
+    read_timeout: float = 60
+    deadline: float = 90
+    context_limit: int = 0
+    context_overflow: str = "truncate"
+    thread_turns: int = 0
+    thread_tokens: int = 2000
+    fallback_endpoints: List[Endpoint] = field(default_factory=list)
+    write_behind: bool = False
+    hedge_percentile: int = 0
+    hedge_model: str = ""
+    model_by_size: List[Tuple[int, str]] = field(default_factory=list)
+    fast_model: str = ""
+    fast_model_latency: float = 0
+    data_dir: str = ""
+
+    @property
+    def state_dir(self) -> str:
+        return os.path.join(self.data_dir, "state")
+
+
+@dataclass
+class Reply:
+    """
+    Outcome of a query. filename is the conversation file the answer can be
+    opened in, if there is one. prompt_tokens is the number of tokens sent,
+    counted locally, and truncated whether the prompt was shortened to fit.
+    model is the model the prompt was sent to, and model_reason why, when it
+    is not the model setting.
+    """
+
+    prompt: str
+    keyword: str
+    completion: Completion
+    filename: Optional[str] = None
+    cached: bool = False
+    prompt_tokens: int = 0
+    truncated: bool = False
+    model: str = ""
+    model_reason: str = ""
+
+
+class ConversationStore:
+    """
+    Saves the conversations for each keyword in an append-only log.
+    """
+
+    def __init__(self, directory: str = "", fsync: bool = False):
+        self.directory = directory
+        self.fsync = fsync
+
+    def filename(self, keyword: str) -> str:
+        return os.path.join(self.directory, f"Conversations '{keyword}' keyword.txt")
+
+    def find(self, keyword: str) -> Optional[str]:
+        filename = self.filename(keyword)
+        return filename if ConversationLog(filename).exists() else None
+
+    def save(self, keyword: str, text: str) -> Optional[str]:
+        filename = self.filename(keyword)
+        try:
+            ConversationLog(filename, fsync=self.fsync).append(text)
+        except PermissionError:
+            logging.error(PermissionError)
+        return filename
+
+
+class MemoryStore:
+    """
+    Keeps conversations in memory, for headless use and benchmarks.
+    """
+
+    def __init__(self):
+        self.conversations: Dict[str, List[str]] = {}
+
+    def filename(self, keyword: str) -> Optional[str]:
+        return None
+
+    def find(self, keyword: str) -> Optional[str]:
+        return None
+
+    def save(self, keyword: str, text: str) -> Optional[str]:
+        self.conversations.setdefault(keyword, []).append(text)
+        return None
+
+
+class Engine:
+    def __init__(
+        self,
+        config: EngineConfig,
+        storage=None,
+        transport: Optional["Transport"] = None,
+    ):
+        self.config = config
+        self.storage = storage or ConversationStore(
+            config.data_dir, config.fsync_conversation
+        )
+        if transport is not None:
+            self.transport = transport
+
+    @cached_property
+    def prompts(self) -> Optional[PromptTable]:
+        return PromptTable.load(
+            os.path.join(self.config.data_dir, "system_messages.csv"),
+            os.path.join(self.config.state_dir, "system_messages.cache"),
+        )
+
+    @cached_property
+    def transport(self) -> "Transport":
+        from plugin.transport import get_transport
+
+        return get_transport(
+            max(self.config.pool_size, self.config.max_parallel_requests),
+            max_retries=self.config.max_retries,
+        )
+
+    @cached_property
+    def limiter(self) -> RateLimiter:
+        return RateLimiter(
+            os.path.join(self.config.state_dir, "ratelimit.json"),
+            requests_per_minute=self.config.requests_per_minute,
+            tokens_per_minute=self.config.tokens_per_minute,
+        )
+
+    def limiter_for(self, endpoint: Endpoint) -> RateLimiter:
+        if endpoint.url == self.config.api_endpoint:
+            return self.limiter
+        name = hashlib.sha1(endpoint.url.encode("utf-8")).hexdigest()[:12]
+        return RateLimiter(
+            os.path.join(self.config.state_dir, f"ratelimit-{name}.json"),
+            requests_per_minute=self.config.requests_per_minute,
+            tokens_per_minute=self.config.tokens_per_minute,
+        )
+
+    @cached_property
+    def router(self) -> Router:
+        primary = Endpoint(self.config.api_endpoint, self.config.api_key)
+        return Router(
+            [primary] + self.config.fallback_endpoints,
+            os.path.join(self.config.state_dir, "endpoints.json"),
+        )
+
+    @cached_property
+    def models(self) -> ModelRouter:
+        return ModelRouter(
+            self.config.model,
+            os.path.join(self.config.state_dir, "models.json"),
+            size_rules=self.config.model_by_size,
+            fast_model=self.config.fast_model,
+            latency_limit=self.config.fast_model_latency,
+        )
+
+    @cached_property
+    def write_behind(self) -> WriteBehind:
+        return WriteBehind(self.config.write_behind)
+
+    @cached_property
+    def hedge_stats(self) -> HedgeStats:
+        return HedgeStats(os.path.join(self.config.state_dir, "hedging.json"))
+
+    @cached_property
+    def generation(self) -> Generation:
+        return Generation(self.config.state_dir)
+
+    @cached_property
+    def threads(self) -> ThreadStore:
+        return ThreadStore(
+            os.path.join(self.config.state_dir, "threads"), self.config.thread_turns
+        )
+
+    def response_cache(self) -> "ResponseCache":
+        from plugin.cache import ResponseCache
+
+        return ResponseCache(
+            os.path.join(self.config.state_dir, "responses.sqlite3"),
+            ttl=self.config.cache_ttl,
+            max_entries=self.config.cache_max_entries,
+            max_bytes=self.config.cache_max_bytes,
+        )
+
+    def split_queries(self, query: str) -> List[str]:
+        """
+        Split a query into the prompts separated by the prompt separator. Each
+        of them keeps the prompt stop, so it can be asked on its own.
+        """
+        separator = self.config.prompt_separator
+        stop = self.config.prompt_stop
+        body = query[: -len(stop)] if stop and query.endswith(stop) else query
+        if not separator or separator not in body:
+            return [query]
+        parts = [part.strip() for part in body.split(separator)]
+        return [f"{part}{stop}" for part in parts if part]
+
+    def ask_all(self, query: str) -> List[Reply]:
+        """
+        Answer every prompt in the query. Separate prompts are sent
+        concurrently, so the total latency is that of the slowest one. The
+        query starts a new generation, which cancels older queries in flight.
+        """
+        queries = self.split_queries(query)
+        generation = self.generation.begin(query)
+        try:
+            if len(queries) == 1:
+                return [self.ask(queries[0], generation)]
+
+            from concurrent.futures import ThreadPoolExecutor
+
+            # Load the shared state once, before the threads race for it
+            self.prompts
+            self.transport
+            self.limiter
+            self.router
+            self.hedge_stats
+            self.write_behind
+            self.models
+            self.threads
+            workers = min(len(queries), max(self.config.max_parallel_requests, 1))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                return list(
+                    executor.map(lambda part: self.ask(part, generation), queries)
+                )
+        finally:
+            self.generation.end(generation)
+
+    def ask(
+        self,
+        query: str,
+        generation: Optional[int] = None,
+        save: bool = True,
+        max_tokens: Optional[int] = None,
+    ) -> Reply:
+        """
+        Answer a query that ends with the prompt stop. Answers come from the
+        response cache when possible, and new answers are saved unless save is
+        False. Cached answers are only saved the first time an answer that was
+        not saved is asked. The same prompt as the newest turn of its thread is
+        answered from the thread. When a newer generation starts, the request
+        is cancelled and nothing is saved. max_tokens caps the answer below the
+        max_tokens of the keyword; an answer cut off by it is not shared.
+        """
+        prompt, prompt_keyword, system_message = self.split_prompt(query)
+
+        history: List[Turn] = []
+        if self.config.thread_turns > 0:
+            turns = self.threads.turns(prompt_keyword)
+            if turns and turns[-1][0] == prompt:
+                # Flow runs the query again when it shows the results again
+                logging.debug("Using the answer of the newest turn of the thread")
+                now = datetime.now()
+                return Reply(
+                    prompt,
+                    prompt_keyword,
+                    Completion(turns[-1][1], now, now),
+                    filename=self.saved_conversation(prompt_keyword),
+                    cached=True,
+                    model=self.config.model,
+                )
+            history = self.threads.recent(
+                prompt_keyword, self.config.thread_tokens, self.config.model
+            )
+
+        choice = self.choose_model(prompt, prompt_keyword, system_message)
+        model = choice.model
+        params = self.prompts.params(prompt_keyword) if self.prompts else {}
+
+        fitted, prompt_tokens, error = self.fit_context(
+            prompt, system_message, history, model, params.get("max_tokens")
+        )
+        if error:
+            now = datetime.now()
+            completion = Completion("", now, now, error=error)
+            return Reply(
+                prompt,
+                prompt_keyword,
+                completion,
+                prompt_tokens=prompt_tokens,
+                model=model,
+                model_reason=choice.reason,
+            )
+        truncated = fitted != prompt
+        prompt = fitted
+
+        cache = None
+        cache_key = ""
+        cacheable = prompt_keyword not in self.config.cache_exclude
+        if self.config.cache_ttl > 0 and cacheable:
+            cache = self.response_cache()
+            cache_key = cache.key(
+                self.config.api_endpoint,
+                self.build_body(prompt, system_message, history, model, params),
+            )
+
+        answer = cache.get(cache_key) if cache else None
+        if answer is not None:
+            logging.debug(f"Using cached answer for key {cache_key}")
+            now = datetime.now()
+            completion = Completion(answer, now, now)
+            if params.get("n", 1) > 1:
+                completion.choices = self.decode_choices(answer)
+                completion.answer = completion.choices[0]
+            if save and self.claim_unsaved(cache_key):
+                filename = self.record(prompt_keyword, prompt, completion)
+            else:
+                filename = self.saved_conversation(prompt_keyword)
+            return Reply(
+                prompt,
+                prompt_keyword,
+                completion,
+                filename=filename,
+                cached=True,
+                prompt_tokens=prompt_tokens,
+                truncated=truncated,
+                model=model,
+                model_reason=choice.reason,
+            )
+
+        from plugin.cache import ResponseCache
+        from plugin.singleflight import Flight
+
+        body = self.build_body(prompt, system_message, history, model, params)
+        flight = Flight(
+            os.path.join(self.config.state_dir, "flights"),
+            cache_key or ResponseCache.key(self.config.api_endpoint, body),
+        )
+        leader, shared = flight.lead_or_wait(self.config.deadline)
+        if not leader:
+            if shared is None:
+                completion = self.timed_out(
+                    datetime.now(), "waiting for an identical request"
+                )
+                filename = None
+            else:
+                completion = Completion.from_dict(shared["completion"])
+                filename = shared["filename"]
+                if save and not shared["saved"] and self.claim_unsaved(cache_key):
+                    filename = self.record(prompt_keyword, prompt, completion)
+            return Reply(
+                prompt,
+                prompt_keyword,
+                completion,
+                filename=filename,
+                prompt_tokens=prompt_tokens,
+                truncated=truncated,
+                model=model,
+                model_reason=choice.reason,
+            )
+
+        capped = max_tokens is not None
+        if capped and params.get("max_tokens", max_tokens + 1) > max_tokens:
+            send_params = dict(params, max_tokens=max_tokens)
+        else:
+            send_params, capped = params, False
+
+        try:
+            completion = self.send_prompt(
+                prompt, system_message, history, generation, model, send_params
+            )
+            logging.info(f"Received answer in {completion.describe()}")
+
+            if not completion.cancelled and not self.generation.is_current(
+                generation
+            ):
+                logging.info("Discarding the answer, a newer query replaced it")
+                completion.cancelled = True
+
+            # Answers cut off by the cap are not the answer to the query
+            cut_off = capped and completion.length_limited
+            save = save and not completion.cancelled and not cut_off
+            if completion.answer and not completion.partial and cache and not cut_off:
+                # Answers that are not saved now are saved when asked again
+                if not save:
+                    self.mark_unsaved(cache_key)
+                answer = completion.answer
+                if params.get("n", 1) > 1:
+                    answer = json.dumps(completion.choices or [answer])
+                self.write_behind.defer(cache.put, cache_key, answer)
+
+            filename = self.conversation_file(prompt_keyword) if save else None
+
+            # Processes waiting for a cancelled request send it themselves
+            if not completion.cancelled and not cut_off:
+                flight.publish(
+                    {
+                        "completion": completion.to_dict(),
+                        "filename": filename,
+                        "saved": save,
+                    }
+                )
+        finally:
+            # Identical requests wait until the answer is in the cache
+            self.write_behind.defer(flight.release)
+
+        if save:
+            self.record(prompt_keyword, prompt, completion)
+
+        return Reply(
+            prompt,
+            prompt_keyword,
+            completion,
+            filename=filename,
+            prompt_tokens=prompt_tokens,
+            truncated=truncated,
+            model=model,
+            model_reason=choice.reason,
+        )
+
+    def choose_model(
+        self, prompt: str, keyword: str, system_message: str
+    ) -> ModelChoice:
+        """
+        Model to send the prompt to. Prompts are only counted when there are
+        rules on their size.
+        """
+        row = self.prompts.get(keyword) if self.prompts else None
+        prompt_tokens = 0
+        if self.config.model_by_size:
+            prompt_tokens = tokens.count_messages(
+                system_message, prompt, self.config.model
+            )
+        choice = self.models.choose(prompt_tokens, (row or {}).get("Model") or "")
+        if choice.reason:
+            logging.info(f"Sending the prompt to {choice.model}, {choice.reason}")
+        return choice
+
+    def record(
+        self, keyword: str, prompt: str, completion: Completion
+    ) -> Optional[str]:
+        """
+        Add a turn to the context thread and the conversation of the keyword,
+        in the background. Returns the conversation file, if there is one.
+        """
+        if self.config.thread_turns > 0 and completion.answer:
+            if not completion.partial:
+                self.write_behind.defer(
+                    self.threads.append, keyword, prompt, completion.answer
+                )
+
+        if self.config.save_conversation:
+            answer = completion.answer
+            if completion.choices:
+                answer = "\n\n".join(
+                    f"Choice {index}: {choice}"
+                    for index, choice in enumerate(completion.choices, 1)
+                )
+            self.write_behind.defer(
+                self.save_conversation,
+                keyword,
+                prompt,
+                completion.prompt_timestamp,
+                answer,
+                completion.answer_timestamp,
+            )
+        return self.conversation_file(keyword)
+
+    @property
+    def unsaved_dir(self) -> str:
+        return os.path.join(self.config.state_dir, "speculation", "unsaved")
+
+    def mark_unsaved(self, cache_key: str) -> None:
+        """
+        Remember that the answer cached under the key was not saved, because
+        it was sent while typing. Marks older than the cache entries they
+        belong to are removed.
+        """
+        now = time.time()
+        try:
+            os.makedirs(self.unsaved_dir, exist_ok=True)
+            with open(os.path.join(self.unsaved_dir, cache_key), "w"):
+                pass
+            with os.scandir(self.unsaved_dir) as entries:
+                for entry in entries:
+                    if now - entry.stat().st_mtime > self.config.cache_ttl:
+                        self.claim_unsaved(entry.name)
+        except OSError as e:
+            logging.warning(f"Unable to mark the answer as unsaved: {e}")
+
+    def claim_unsaved(self, cache_key: str) -> bool:
+        """
+        Whether the answer cached under the key still has to be saved. Only
+        the first query that asks for it saves it, later ones are re-runs.
+        """
+        if not cache_key:
+            return False
+        try:
+            os.remove(os.path.join(self.unsaved_dir, cache_key))
+            return True
+        except OSError:
+            return False
+
+    def conversation_file(self, keyword: str) -> Optional[str]:
+        """
+        File the conversation of the keyword is saved in, or None when the
+        conversations are not saved, so the answer itself is opened.
+        """
+        if not self.config.save_conversation:
+            return None
+        return self.storage.filename(keyword)
+
+    def saved_conversation(self, keyword: str) -> Optional[str]:
+        """
+        Conversation file of the keyword if it exists and conversations are
+        saved, for answers that were saved before.
+        """
+        if not self.config.save_conversation:
+            return None
+        return self.storage.find(keyword)
+
+    @staticmethod
+    def decode_choices(answer: str) -> List[str]:
+        """
+        Choices of a cached answer to a request for several of them, which is
+        a JSON list of strings. Anything else is used as a single choice.
+        """
+        try:
+            choices = json.loads(answer)
+        except ValueError:
+            return [answer]
+        if not isinstance(choices, list) or not choices:
+            return [answer]
+        if not all(isinstance(choice, str) for choice in choices):
+            return [answer]
+        return choices
+
+    def fit_context(
+        self,
+        prompt: str,
+        system_message: str,
+        history: List[Turn] = (),
+        model: Optional[str] = None,
+        answer_tokens: Optional[int] = None,
+    ) -> Tuple[str, int, str]:
+        """
+        Make sure the prompt and its history fit in the context window of the
+        model, leaving room for the answer. Returns the prompt, which is
+        shortened when it is too long and context_overflow is "truncate", the
+        number of tokens sent, and an error message when it cannot be sent.
+        The room left for the answer is answer_tokens when the answer is capped.
+        """
+        model = model or self.config.model
+        prompt_tokens = tokens.count_messages(system_message, prompt, model)
+        for turn in history:
+            prompt_tokens += sum(tokens.count(text, model) for text in turn)
+            prompt_tokens += 2 * tokens.TOKENS_PER_MESSAGE
+        limit = self.config.context_limit or tokens.context_limit(model)
+        if not limit:
+            return prompt, prompt_tokens, ""
+
+        reserve = answer_tokens or tokens.ANSWER_RESERVE
+        available = limit - min(reserve, limit // 4)
+        if prompt_tokens <= available:
+            return prompt, prompt_tokens, ""
+
+        error = (
+            f"The prompt has about {prompt_tokens} tokens, "
+            f"{model} accepts {available} with room for the answer"
+        )
+        if self.config.context_overflow == "refuse":
+            return prompt, prompt_tokens, error
+
+        overhead = prompt_tokens - tokens.count(prompt, model)
+        truncated, truncated_tokens = tokens.truncate(
+            prompt, available - overhead, model
+        )
+        if not truncated:
+            return prompt, prompt_tokens, error
+        logging.warning(
+            f"Truncated the prompt from {prompt_tokens} to "
+            f"{truncated_tokens + overhead} tokens"
+        )
+        return truncated, truncated_tokens + overhead, ""
+
+    def build_body(
+        self,
+        prompt: str,
+        system_message: str,
+        history: List[Turn] = (),
+        model: Optional[str] = None,
+        params: Optional[dict] = None,
+    ) -> dict:
+        messages = [
+            {
+                "role": "system",
+                "content": system_message,
+            }
+        ]
+        for previous_prompt, previous_answer in history:
+            messages.append({"role": "user", "content": previous_prompt})
+            messages.append({"role": "assistant", "content": previous_answer})
+        messages.append({"role": "user", "content": prompt})
+        return {
+            "model": model or self.config.model,
+            "messages": messages,
+            **(params or {}),
+        }
+
+    def send_prompt(
+        self,
+        prompt: str,
+        system_message: str,
+        history: List[Turn] = (),
+        generation: Optional[int] = None,
+        model: Optional[str] = None,
+        params: Optional[dict] = None,
+    ) -> Completion:
+        """
+        Query the OpenAI end-point. The endpoints are tried from the healthiest
+        one on, moving to the next one when a request fails in a way another
+        endpoint may not, until the deadline.
+        """
+        body = self.build_body(prompt, system_message, history, model, params)
+        if self.config.stream:
+            body["stream"] = True
+
+        prompt_timestamp = datetime.now()
+        deadline = time.monotonic() + self.config.deadline
+
+        endpoints = self.router.order()
+        completion, failover, tried = None, True, 0
+        if self.config.hedge_percentile > 0:
+            delay = self.router.percentile(endpoints[0], self.config.hedge_percentile)
+            if delay is not None and not self.limiter_for(endpoints[0]).paused():
+                completion, failover, tried = self.send_hedged(
+                    endpoints, body, prompt_timestamp, deadline, generation, delay
+                )
+
+        for index, endpoint in enumerate(endpoints[tried:], tried):
+            if not failover:
+                break
+            if completion is not None:
+                logging.warning("Request failed, trying the next endpoint")
+                if time.monotonic() >= deadline:
+                    break
+            last = index == len(endpoints) - 1
+            if not last and self.limiter_for(endpoint).paused():
+                logging.info(f"Skipping {endpoint.url}, it is rate limited")
+                continue
+            completion, failover = self.send_to(
+                endpoint, body, prompt_timestamp, deadline, generation
+            )
+        return completion
+
+    def send_hedged(
+        self,
+        endpoints: List[Endpoint],
+        body: dict,
+        prompt_timestamp: datetime,
+        deadline: float,
+        generation: Optional[int],
+        delay: float,
+    ) -> Tuple[Completion, bool, int]:
+        """
+        Send the request to the first endpoint and, when its response has not
+        started after delay seconds, a duplicate to the next endpoint, or the
+        same one without others, using hedge_model if set. The first response
+        to start is used and the other request stopped. Returns the completion,
+        whether to fail over and how many endpoints were used.
+        """
+        import threading
+        from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+        from plugin.transport import Abort
+
+        race = Race()
+
+        def start(name: str, endpoint: Endpoint, body: dict) -> Future:
+            future = Future()
+            abort = Abort()
+            race.add(name, abort.abort)
+
+            def run():
+                try:
+                    future.set_result(
+                        self.send_to(
+                            endpoint,
+                            body,
+                            prompt_timestamp,
+                            deadline,
+                            generation,
+                            claim=lambda: race.claim(name),
+                            abort=abort,
+                        )
+                    )
+                except BaseException as e:
+                    future.set_exception(e)
+
+            # A request that lost the race must not keep the process alive
+            threading.Thread(target=run, daemon=True).start()
+            return future
+
+        primary = endpoints[0]
+        sent = time.monotonic()
+        first = start("first", primary, body)
+        if wait([first], timeout=delay).done or race.winner:
+            self.write_behind.defer(self.hedge_stats.add)
+            completion, failover = first.result()
+            return completion, failover, 1
+
+        backup = endpoints[1] if len(endpoints) > 1 else primary
+        if self.config.hedge_model:
+            body = dict(body, model=self.config.hedge_model)
+        logging.info(
+            f"No response after {delay:.2f}s, sending a duplicate to {backup.url}"
+        )
+        names = {first: "first", start("second", backup, body): "second"}
+
+        completion, failover = None, True
+        pending = set(names)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if race.winner == names[future]:
+                    completion, failover = result
+                    pending = set()
+                    break
+                if completion is None or names[future] == "first":
+                    completion, failover = result
+
+        won = race.winner == "second"
+        if won:
+            completion.hedged = True
+            # The first request was at least this slow
+            self.write_behind.defer(
+                self.router.record, primary, race.decided_at - sent, True
+            )
+        extra_tokens = tokens.TOKENS_PER_REPLY + sum(
+            tokens.count(message["content"], body["model"])
+            + tokens.TOKENS_PER_MESSAGE
+            for message in body["messages"]
+        )
+        self.write_behind.defer(self.count_hedge, won, extra_tokens)
+        return completion, failover, 1 if backup is primary else 2
+
+    def count_hedge(self, won: bool, extra_tokens: int) -> None:
+        self.hedge_stats.add(hedged=True, won=won, extra_tokens=extra_tokens)
+        logging.info(self.hedge_stats.describe(self.config.model))
+
+    def send_to(
+        self,
+        endpoint: Endpoint,
+        body: dict,
+        prompt_timestamp: datetime,
+        deadline: float,
+        generation: Optional[int] = None,
+        claim: Optional[Callable[[], bool]] = None,
+        abort: Optional["Abort"] = None,
+    ) -> Tuple[Completion, bool]:
+        """
+        Send the request to one endpoint and record how it went. Returns the
+        completion and whether the next endpoint should be tried. When claim
+        returns False once the response starts, another request answered
+        first, and the response is dropped before its body is read. abort
+        stops the request when another one answers first while it waits.
+        """
+        stream = body.get("stream", False)
+        headers = {
+            "Authorization": "Bearer " + endpoint.api_key,
+            "Content-Type": "application/json",
+        }
+        data = json.dumps(dict(body, model=endpoint.model_for(body["model"])))
+
+        import requests
+        from urllib3.util import Timeout
+
+        # Roughly four characters per token
+        limiter = self.limiter_for(endpoint)
+        limiter.acquire(
+            tokens=len(data) // 4, max_wait=max(deadline - time.monotonic(), 0)
+        )
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            completion = self.timed_out(prompt_timestamp, "waiting for the rate limit")
+            return completion, False
+        if not self.generation.is_current(generation):
+            logging.info("Not sending the prompt, a newer query replaced it")
+            completion = Completion("", prompt_timestamp, datetime.now())
+            completion.cancelled = True
+            return completion, False
+        timeout = Timeout(
+            connect=min(self.config.connect_timeout, remaining),
+            read=min(self.config.read_timeout, remaining),
+            total=remaining,
+        )
+
+        logging.debug(f"Sending request to {endpoint.url} with data: {data}")
+        started = time.monotonic()
+        try:
+            response = self.transport.post(
+                endpoint.url,
+                headers=headers,
+                data=data,
+                proxies=PROXIES,
+                # Hedged responses are claimed before their body is read
+                stream=stream or claim is not None,
+                timeout=timeout,
+                deadline=deadline,
+                abort=abort,
+            )
+        except UnicodeEncodeError as e:
+            logging.error(f"UnicodeEncodeError: {e}")
+            return Completion("", prompt_timestamp, datetime.now()), False
+        except requests.exceptions.RequestException as e:
+            if abort is not None and abort.aborted:
+                logging.debug(f"Stopped the request to {endpoint.url}, it was hedged")
+                completion = Completion("", prompt_timestamp, datetime.now())
+                completion.cancelled = True
+                return completion, False
+            self.write_behind.defer(self.router.record, endpoint, 0, False)
+            phase = self.timeout_phase(e, deadline)
+            if phase:
+                return self.timed_out(prompt_timestamp, phase), True
+            logging.error(f"Request failed: {e}")
+            completion = Completion("", prompt_timestamp, datetime.now())
+            completion.error = f"Unable to reach the API: {type(e).__name__}"
+            return completion, True
+
+        logging.debug(f"Response: {response}")
+        latency = time.monotonic() - started
+        limiter.update(response.headers, response.status_code)
+        if hasattr(self.transport, "stats"):
+            logging.debug(f"Connection pool: {self.transport.stats()}")
+
+        if response.ok and claim is not None and not claim():
+            logging.debug(f"Dropping the response of {endpoint.url}, it was hedged")
+            response.close()
+            completion = Completion("", prompt_timestamp, datetime.now())
+            completion.cancelled = True
+            return completion, False
+
+        failover = not response.ok and (
+            response.status_code >= 500 or response.status_code in FAILOVER_STATUSES
+        )
+        if response.ok or failover:
+            self.write_behind.defer(self.router.record, endpoint, latency, response.ok)
+        if response.ok:
+            self.write_behind.defer(self.models.record, body["model"], latency)
+
+        if response.ok and stream:
+            completion = self.read_stream(
+                response, prompt_timestamp, deadline, generation
+            )
+            return completion, False
+
+        answer_timestamp = datetime.now()
+
+        completion = Completion("", prompt_timestamp, answer_timestamp)
+        try:
+            response_json = response.json()
+        except ValueError:
+            response_json = {"error": {"message": f"HTTP {response.status_code}"}}
+        if response.ok:
+            choices = [
+                entry["message"]["content"] for entry in response_json["choices"]
+            ]
+            completion.answer = choices[0] if choices else ""
+            if len(choices) > 1:
+                completion.choices = choices
+            completion.length_limited = any(
+                entry.get("finish_reason") == "length"
+                for entry in response_json["choices"]
+            )
+        else:
+            # Other OpenAI-compatible servers shape their errors differently
+            error = None
+            if isinstance(response_json, dict):
+                error = response_json.get("error")
+            if isinstance(error, dict):
+                error = error.get("message")
+            if not error or not isinstance(error, str):
+                error = f"HTTP {response.status_code}"
+            completion.error = error
+            logging.error(
+                f"API returned {response.status_code} with message: {response_json}"
+            )
+        return completion, failover
+
+    def timeout_phase(self, error: Exception, deadline: float) -> str:
+        """
+        What the request was doing when it timed out, or an empty string when
+        the error is not a timeout.
+        """
+        from urllib3.exceptions import (
+            ConnectTimeoutError,
+            NewConnectionError,
+            ReadTimeoutError,
+        )
+
+        # Errors raised after the retries are exhausted wrap the last error
+        reason = error.args[0] if error.args else None
+        reason = getattr(reason, "reason", reason)
+        if isinstance(reason, NewConnectionError):
+            return ""
+        if isinstance(reason, ConnectTimeoutError):
+            return "connecting"
+        if isinstance(reason, ReadTimeoutError):
+            return "waiting for the answer"
+        if time.monotonic() >= deadline:
+            return "retrying"
+        return ""
+
+    def timed_out(self, prompt_timestamp: datetime, phase: str) -> Completion:
+        completion = Completion("", prompt_timestamp, datetime.now())
+        completion.timeout_phase = phase
+        logging.error(f"Request timed out after {completion.latency:.1f}s, {phase}")
+        return completion
+
+    def read_stream(
+        self,
+        response: "requests.Response",
+        prompt_timestamp: datetime,
+        deadline: Optional[float] = None,
+        generation: Optional[int] = None,
+    ) -> Completion:
+        """
+        Collect the answer from the server-sent events of a streaming response.
+        Whatever has been received so far is returned when the stream breaks off
+        or the deadline, on the time.monotonic clock, is reached. The stream is
+        closed as soon as a newer generation starts.
+        """
+        import requests
+        from urllib3.exceptions import ReadTimeoutError
+
+        parts: Dict[int, List[str]] = {}
+        finished = set()
+        completion = Completion("", prompt_timestamp, prompt_timestamp)
+        completion.partial = True
+        watch = self.generation.watch(generation)
+
+        try:
+            for line in response.iter_lines():
+                if deadline is not None and time.monotonic() >= deadline:
+                    completion.timeout_phase = "reading the answer"
+                    break
+                if watch.is_stale():
+                    logging.info("Cancelling the stream, a newer query replaced it")
+                    completion.cancelled = True
+                    break
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    completion.partial = False
+                    break
+
+                chunk = json.loads(data)
+                if "error" in chunk:
+                    completion.error = chunk["error"].get("message", "")
+                    logging.error(f"API returned an error in the stream: {chunk}")
+                    break
+
+                for choice in chunk.get("choices", []):
+                    index = choice.get("index", 0)
+                    if choice.get("finish_reason"):
+                        if choice["finish_reason"] == "length":
+                            completion.length_limited = True
+                        finished.add(index)
+                        completion.partial = not finished.issuperset(parts)
+                    content = choice.get("delta", {}).get("content")
+                    if not content:
+                        continue
+                    if completion.first_token_timestamp is None:
+                        completion.first_token_timestamp = datetime.now()
+                    parts.setdefault(index, []).append(content)
+                    completion.tokens += 1
+        except (requests.exceptions.RequestException, ValueError) as e:
+            if any(isinstance(arg, ReadTimeoutError) for arg in e.args):
+                completion.timeout_phase = "reading the answer"
+            logging.error(f"Stream interrupted: {e}")
+        finally:
+            response.close()
+
+        choices = ["".join(parts[index]) for index in sorted(parts)]
+        completion.answer = choices[0] if choices else ""
+        if len(choices) > 1:
+            completion.choices = choices
+        completion.answer_timestamp = datetime.now()
+        if completion.timeout_phase:
+            logging.error(
+                f"Request timed out after {completion.latency:.1f}s, "
+                f"{completion.timeout_phase}"
+            )
+        return completion
+
+    def save_conversation(
+        self,
+        keyword: str,
+        prompt: str,
+        prompt_timestamp: datetime,
+        answer: str,
+        answer_timestamp: datetime,
+    ) -> Optional[str]:
+        formatted_prompt_timestamp = prompt_timestamp.strftime("%Y-%m-%d %H:%M:%S")
+        formatted_answer_timestamp = answer_timestamp.strftime("%Y-%m-%d %H:%M:%S")
+        new_content = f"[{formatted_prompt_timestamp}] User: {prompt}\n[{formatted_answer_timestamp}] ChatGPT: {answer}\n\n"  # noqa: E501
+
+        return self.storage.save(keyword, new_content)
+
+    def split_prompt(self, query: str) -> Tuple[str, str, str]:
+        prompt = query.rstrip(self.config.prompt_stop).strip()
+        prompt_array = prompt.split(" ")
+        prompt_keyword = prompt_array[0].lower()
+
+        system_message = ""
+
+        row = self.prompts.get(prompt_keyword)
+        if row:
+            system_message = row["System Message"]
+            if len(prompt_array) > 1:
+                prompt = prompt.split(" ", 1)[1]
+
+        if not system_message:
+            prompt_keyword = self.config.default_system_prompt
+
+            row = self.prompts.get(self.config.default_system_prompt)
+            if row:
+                system_message = row["System Message"]
+
+        if len(prompt_array) == 1:
+            prompt = prompt_array[0]
+
+        logging.debug(
+            f"""
+        Prompt: {prompt}
+        Prompt keyword: {prompt_keyword}
+        System message: {system_message}
+        """
+        )
+
+        return prompt, prompt_keyword, system_message
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+from typing import Optional, Tuple
+
+from plugin.locks import FileLock, atomic_write
+
+# Seconds between checks of the generation file while an answer streams in
+CHECK_INTERVAL = 0.1
+
+
+def strip_prompt_stop(query: str, prompt_stop: str) -> str:
+    """
+    The query without whitespace and without the prompt stop at its end, or
+    the start of one that is being typed.
+    """
+    query = query.strip()
+    for length in range(len(prompt_stop), 0, -1):
+        if query.endswith(prompt_stop[:length]):
+            return query[:-length].rstrip()
+    return query
+
+
+class Generation:
+    """
+    Counter shared by all plugin processes that tells which query is the
+    latest one.
+
+    Every query that sends prompts starts a new generation and marks it as
+    in flight. When the query text changes, a newer generation starts, and
+    requests of older generations are cancelled or their answers discarded.
+    The same query sent again while it is in flight joins its generation.
+    The typing path only takes the lock when a request is in flight, so it
+    normally costs a single stat call.
+    """
+
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, "generation")
+        self.inflight_path = os.path.join(directory, "inflight")
+        self.lock_path = os.path.join(directory, "generation.lock")
+
+    def begin(self, query: str = "") -> int:
+        """
+        Start a generation for a query that sends prompts, making any request
+        still in flight for another query stale.
+        """
+        with FileLock(self.lock_path):
+            inflight, inflight_query = self._read_inflight()
+            generation = self._read(self.path)
+            if query and inflight == generation and inflight_query == query:
+                return generation
+            generation += 1
+            self._write(self.path, generation)
+            self._write(self.inflight_path, f"{generation}\n{query}")
+        return generation
+
+    def end(self, generation: int) -> None:
+        with FileLock(self.lock_path):
+            if self._read_inflight()[0] == generation:
+                self._remove(self.inflight_path)
+
+    def bump_if_inflight(
+        self, query: Optional[str] = None, prompt_stop: str = ""
+    ) -> None:
+        """
+        Make the request in flight stale, if there is one. Called when the
+        query text changed without sending a prompt. When the query is given,
+        text that is the start of the query in flight is not an edit: Flow
+        can run the processes of earlier keystrokes after the one that sent
+        the prompt.
+        """
+        if not os.path.exists(self.inflight_path):
+            return
+        with FileLock(self.lock_path):
+            inflight, inflight_query = self._read_inflight()
+            if not inflight:
+                return
+            if query is not None:
+                text = strip_prompt_stop(query, prompt_stop)
+                if strip_prompt_stop(inflight_query, prompt_stop).startswith(text):
+                    return
+            self._write(self.path, self._read(self.path) + 1)
+            self._remove(self.inflight_path)
+
+    def is_current(self, generation: Optional[int]) -> bool:
+        return generation is None or self._read(self.path) == generation
+
+    def watch(self, generation: Optional[int]) -> "GenerationWatch":
+        return GenerationWatch(self, generation)
+
+    def _read_inflight(self) -> Tuple[int, str]:
+        try:
+            with open(self.inflight_path, "r", encoding="utf-8") as f:
+                generation, _, query = f.read().partition("\n")
+            return int(generation), query
+        except (OSError, ValueError):
+            return 0, ""
+
+    @staticmethod
+    def _read(path: str) -> int:
+        try:
+            with open(path, "r") as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    @staticmethod
+    def _write(path: str, value) -> None:
+        with atomic_write(path) as f:
+            f.write(str(value))
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class GenerationWatch:
+    """
+    Checks whether a generation is still current at most every
+    CHECK_INTERVAL seconds, for loops that run for every streamed chunk.
+    """
+
+    def __init__(self, generation: Generation, current: Optional[int]):
+        self.generation = generation
+        self.current = current
+        self.checked = time.monotonic()
+        self.stale = False
+
+    def is_stale(self) -> bool:
+        if self.stale or self.current is None:
+            return self.stale
+        now = time.monotonic()
+        if now - self.checked >= CHECK_INTERVAL:
+            self.checked = now
+            self.stale = not self.generation.is_current(self.current)
+        return self.stale
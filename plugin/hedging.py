@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+"""
+Hedged requests.
+
+When the response to a request has not started after a percentile of the
+recent response times of its endpoint, a duplicate is sent to the next
+endpoint. Whichever response starts first is used, and the other request
+is stopped right away. The duplicates are counted, with the prompt tokens
+they cost, so the percentile can be tuned.
+"""
+
+import json
+import time
+import logging
+import threading
+from typing import Callable, Dict, Optional
+
+from plugin import tokens
+from plugin.locks import FileLock, atomic_write
+
+
+class Race:
+    """
+    Decides which of the requests sent for the same prompt answered first,
+    and stops the others as soon as it is decided.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.winner: Optional[str] = None
+        self.decided_at: Optional[float] = None
+        self._stops: Dict[str, Callable[[], None]] = {}
+
+    def add(self, name: str, stop: Callable[[], None]) -> None:
+        """
+        Enter a request, with the function that stops it when it loses.
+        """
+        with self._lock:
+            self._stops[name] = stop
+            if self.winner is not None and self.winner != name:
+                stop()
+
+    def claim(self, name: str) -> bool:
+        """
+        Called when the response of a request starts. Returns whether it is
+        the first one, and should be used.
+        """
+        with self._lock:
+            if self.winner is None:
+                self.winner = name
+                self.decided_at = time.monotonic()
+                for other, stop in self._stops.items():
+                    if other != name:
+                        stop()
+            return self.winner == name
+
+
+class HedgeStats:
+    """
+    How many requests could be hedged, how many were, how often the duplicate
+    answered first and the prompt tokens the duplicates cost. Shared by all
+    plugin processes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+
+    def add(self, hedged: bool = False, won: bool = False, extra_tokens: int = 0):
+        try:
+            with FileLock(self.lock_path):
+                stats = self.load()
+                stats["requests"] = stats.get("requests", 0) + 1
+                stats["hedged"] = stats.get("hedged", 0) + hedged
+                stats["won"] = stats.get("won", 0) + won
+                stats["extra_tokens"] = stats.get("extra_tokens", 0) + extra_tokens
+                with atomic_write(self.path) as f:
+                    json.dump(stats, f)
+        except OSError as e:
+            logging.warning(f"Unable to save the hedging statistics: {e}")
+
+    def load(self) -> dict:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def describe(self, model: str) -> str:
+        stats = self.load()
+        requests = stats.get("requests", 0)
+        hedged = stats.get("hedged", 0)
+        extra_tokens = stats.get("extra_tokens", 0)
+        rate = 100 * hedged / requests if requests else 0
+        description = (
+            f"Hedged {hedged} of {requests} requests ({rate:.1f}%), the duplicate "
+            f"answered first {stats.get('won', 0)} times, ~{extra_tokens} extra "
+            "prompt tokens"
+        )
+        cost = tokens.input_cost(model, extra_tokens)
+        if cost is not None:
+            description += f" (~${cost:.4f})"
+        return description
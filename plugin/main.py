@@ -1,42 +1,95 @@
 # -*- coding: utf-8 -*-
 
 import os
-import csv
+import sys
+import time
 import logging
-from datetime import datetime
+from functools import cached_property
 from flox import Flox  # noqa: E402
-import webbrowser  # noqa: E402
-import requests  # noqa: E402
 import json  # noqa: E402
-import pyperclip  # noqa: E402
-from typing import Tuple, Optional
+from typing import Optional
 
-PROXIES = {
-    "http": os.environ.get("HTTP_PROXY", ""),
-    "https": os.environ.get("HTTPS_PROXY", ""),
-}
+from plugin import actions, answers, tokens, worker
+from plugin.engine import Engine, EngineConfig, Reply
+from plugin.models import parse_size_rules
+from plugin.router import parse_endpoints
+from plugin.speculation import Speculation
+
+# requests, pyperclip, webbrowser and sqlite3 are imported where they are
+# used, so the typing path doesn't pay for loading them
 
 
 class ChatGPT(Flox):
-    def __init__(self):
+    """
+    Flow Launcher adapter for the prompt engine.
+    """
+
+    def __init__(self, argv: Optional[str] = None, output: Optional[list] = None):
+        self._argv = argv
+        self._output = output
+        self._results = []
+        self._start = time.time()
+
         self.api_key = self.settings.get("api_key")
         self.model = self.settings.get("model")
         self.prompt_stop = self.settings.get("prompt_stop")
-        self.default_system_prompt = self.settings.get("default_prompt")
-        self.save_conversation_setting = self.settings.get("save_conversation")
         self.log_level = self.settings.get("log_level")
-        self.api_endpoint = self.settings.get("api_endpoint")
+        self.worker_idle_timeout = self.settings_int(
+            "worker_idle_timeout", worker.DEFAULT_IDLE_TIMEOUT // 60
+        ) * 60
         self.logger_level(self.log_level)
 
-        try:
-            self.csv_file = open("system_messages.csv", encoding="utf-8", mode="r")
-            reader = csv.DictReader(self.csv_file, delimiter=";")
-            self.prompts = list(reader)
-            [logging.debug(f"Found prompt: {row}") for row in self.prompts]
+        self.engine = Engine(
+            EngineConfig(
+                api_key=self.api_key,
+                model=self.model,
+                api_endpoint=self.settings.get("api_endpoint"),
+                prompt_stop=self.prompt_stop,
+                default_system_prompt=self.settings.get("default_prompt"),
+                stream=bool(self.settings.get("stream")),
+                save_conversation=bool(self.settings.get("save_conversation")),
+                fsync_conversation=self.settings.get("conversation_fsync")
+                == "always",
+                cache_ttl=self.settings_int("cache_ttl", 1440) * 60,
+                cache_max_entries=self.settings_int("cache_max_entries", 500),
+                cache_max_bytes=self.settings_int("cache_max_size", 20) * 1024 * 1024,
+                cache_exclude=[
+                    keyword.strip().lower()
+                    for keyword in (self.settings.get("cache_exclude") or "").split(",")
+                    if keyword.strip()
+                ],
+                pool_size=self.settings_int("connection_pool_size", 4),
+                prompt_separator=self.settings.get("prompt_separator") or "",
+                max_parallel_requests=self.settings_int("max_parallel_requests", 4),
+                max_retries=self.settings_int("max_retries", 3),
+                requests_per_minute=self.settings_int("requests_per_minute", 0),
+                tokens_per_minute=self.settings_int("tokens_per_minute", 0),
+                connect_timeout=self.settings_int("connect_timeout", 5),
+                read_timeout=self.settings_int("read_timeout", 60),
+                deadline=self.settings_int("request_deadline", 90),
+                context_limit=self.settings_int("context_limit", 0),
+                context_overflow=self.settings.get("context_overflow") or "truncate",
+                thread_turns=self.settings_int("thread_turns", 0),
+                thread_tokens=self.settings_int("thread_tokens", 2000),
+                fallback_endpoints=parse_endpoints(
+                    self.settings.get("fallback_endpoints"), self.api_key
+                ),
+                hedge_percentile=self.settings_int("hedge_percentile", 0),
+                hedge_model=self.settings.get("hedge_model") or "",
+                model_by_size=parse_size_rules(self.settings.get("model_by_size")),
+                fast_model=self.settings.get("fast_model") or "",
+                fast_model_latency=self.settings_int("fast_model_latency", 0),
+                write_behind=True,
+            )
+        )
+
+        self.speculative_delay = self.settings_int("speculative_delay", 0) / 1000
+        self.speculative_daily_tokens = self.settings_int(
+            "speculative_daily_tokens", 20000
+        )
 
-        except FileNotFoundError:
-            self.prompts = None
-            logging.error("Unable to open system_messages.csv")
+        if self.settings.get("resident_worker") and self._output is None:
+            worker.spawn()
 
     def query(self, query: str) -> None:
         if not self.api_key:
@@ -47,194 +100,144 @@ class ChatGPT(Flox):
                 ),
             )
             return
-        if self.prompts is None:
-            self.add_item(
-                title="Unable to load the system prompts from CSV",
-                subtitle="Please validate that the plugins folder contains a valid system_prompts.csv",  # noqa: E501
-                method=self.open_plugin_folder,
-            )
-            return
         if query.endswith(self.prompt_stop):
-            prompt, prompt_keyword, system_message = self.split_prompt(query)
-
-            answer, prompt_timestamp, answer_timestamp = self.send_prompt(
-                prompt, system_message
-            )
-
-            filename = None
-            if self.save_conversation_setting:
-                filename = self.save_conversation(
-                    prompt_keyword, prompt, prompt_timestamp, answer, answer_timestamp
-                )
-
-            if answer:
-                answer = answer.lstrip("\n").lstrip("\n")
-                short_answer = self.ellipsis(answer, 30)
-
+            if self.engine.prompts is None:
                 self.add_item(
-                    title="Copy to clipboard",
-                    subtitle=f"Answer: {short_answer}",
-                    method=self.copy_answer,
-                    parameters=[answer],
+                    title="Unable to load the system prompts from CSV",
+                    subtitle="Please validate that the plugins folder contains a valid system_prompts.csv",  # noqa: E501
+                    method=self.open_plugin_folder,
                 )
-
-                self.add_item(
-                    title="Open in text editor",
-                    subtitle=f"Answer: {short_answer}",
-                    method=self.open_in_editor,
-                    parameters=[filename, answer],
-                )
-
-
+                return
+
+            replies = self.engine.ask_all(query)
+            for reply in replies:
+                self.show_reply(reply, fan_out=len(replies) > 1)
+            if self.engine.config.thread_turns > 0:
+                for keyword in dict.fromkeys(reply.keyword for reply in replies):
+                    self.add_item(
+                        title=f"Start a new '{keyword}' thread",
+                        subtitle="Forget the earlier prompts of this keyword",
+                        method=self.new_thread,
+                        parameters=[keyword],
+                    )
         else:
+            self.engine.generation.bump_if_inflight(query, self.prompt_stop)
+            if self.speculative_delay > 0:
+                self.speculation.note(query, self.prompt_stop)
+            subtitle = f"Current model: {self.model}"
+            if query.strip():
+                subtitle += f", {self.describe_tokens(tokens.estimate(query))}"
             self.add_item(
                 title=f"Type your prompt and end with {self.prompt_stop}",
-                subtitle=f"Current model: {self.model}",
+                subtitle=subtitle,
             )
         return
 
-    def send_prompt(
-        self, prompt: str, system_message: str
-    ) -> Tuple[str, datetime, datetime]:
+    def show_reply(self, reply: Reply, fan_out: bool = False) -> None:
         """
-        Query the OpenAI end-point
+        Add the results for a reply. When several prompts were asked at once,
+        the titles name the prompt and the subtitles show the time it took.
         """
-        url = self.api_endpoint
-
-        headers = {
-            "Authorization": "Bearer " + self.api_key,
-            "Content-Type": "application/json",
-        }
-
-        body = {
-            "model": self.model,
-            "messages": [
-                {
-                    "role": "system",
-                    "content": system_message,
-                },
-                {"role": "user", "content": prompt},
-            ],
-        }
-
-        data = json.dumps(body)
-
-        prompt_timestamp = datetime.now()
-        logging.debug(f"Sending request with data: {data}")
-        try:
-            response = requests.request(
-                "POST", url, headers=headers, data=data, proxies=PROXIES
+        completion = reply.completion
+        suffix = ""
+        if fan_out:
+            suffix = f" ({reply.keyword}: {self.ellipsis(reply.prompt, 30)})"
+
+        if completion.cancelled:
+            self.add_item(
+                title=f"Cancelled{suffix}",
+                subtitle="A newer query replaced this prompt",
             )
-        except UnicodeEncodeError as e:
-            logging.error(f"UnicodeEncodeError: {e}")
-            return "", prompt_timestamp, datetime.now()
-
-        logging.debug(f"Response: {response}")
-        answer_timestamp = datetime.now()
-
-        result = ""
-        response_json = response.json()
-        if response.ok:
-            for entry in response_json["choices"]:
-                result += entry["message"]["content"]
-        else:
+            return
+
+        if completion.error:
             self.add_item(
-                title="An error occurred", subtitle=response_json["error"]["message"]
+                title=f"An error occurred{suffix}", subtitle=completion.error
             )
-            logging.error(
-                f"API returned {response.status_code} with message: {response_json}"
+        if completion.timeout_phase:
+            self.add_item(
+                title=f"Request timed out{suffix}",
+                subtitle=f"Gave up after {completion.latency:.1f}s while "
+                f"{completion.timeout_phase}",
             )
-        return result, prompt_timestamp, answer_timestamp
-
-    def save_conversation(
-        self,
-        keyword: str,
-        prompt: str,
-        prompt_timestamp: datetime,
-        answer: str,
-        answer_timestamp: datetime,
-    ) -> str:
-        filename = f"Conversations '{keyword}' keyword.txt"
-        formatted_prompt_timestamp = prompt_timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        formatted_answer_timestamp = answer_timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        new_content = f"[{formatted_prompt_timestamp}] User: {prompt}\n[{formatted_answer_timestamp}] ChatGPT: {answer}\n\n"  # noqa: E501
-
-        if os.path.exists(filename):
-            try:
-                with open(filename, "r", encoding="utf-8") as file:
-                    existing_content = file.read()
-            except PermissionError:
-                logging.error(PermissionError)
-        else:
-            existing_content = ""
-
-        new_content = new_content + existing_content
-
-        try:
-            with open(filename, "w", encoding="utf-8") as file:
-                file.write(new_content)
-        except PermissionError:
-            logging.error(PermissionError)
-
-        return filename
-
-    def split_prompt(self, query: str) -> Tuple[str, str, str]:
-        prompt = query.rstrip(self.prompt_stop).strip()
-        prompt_array = prompt.split(" ")
-        prompt_keyword = prompt_array[0].lower()
 
-        system_message = ""
-
-        for row in self.prompts:
-            if row["Key Word"] == prompt_keyword:
-                system_message = row["System Message"]
-                prompt = prompt.split(" ", 1)[1]
+        if reply.truncated:
+            self.add_item(
+                title=f"Prompt truncated{suffix}",
+                subtitle=f"Shortened to {reply.prompt_tokens} tokens to fit the "
+                f"context window of {reply.model or self.model}",
+            )
 
-        if not system_message:
-            prompt_keyword = self.default_system_prompt
+        choices = completion.choices or [completion.answer]
+        self.engine.write_behind.defer(answers.clean)
+        for index, answer in enumerate(choices, 1):
+            if not answer:
+                continue
+            answer = answer.lstrip("\n").lstrip("\n")
+            short_answer = self.ellipsis(answer, 30)
+            if not reply.cached and reply.prompt_tokens:
+                short_answer += (
+                    f" ({self.describe_tokens(reply.prompt_tokens, reply.model)})"
+                )
+            single = len(choices) == 1
+            label = "Answer" if single else f"Choice {index} of {len(choices)}"
+            if reply.cached:
+                label += " (cached)"
+            elif completion.partial:
+                label = "Partial answer" if single else f"{label} (partial)"
+            elif completion.hedged:
+                label += " (hedged)"
+            if reply.model_reason:
+                label += f" from {reply.model} ({reply.model_reason})"
+            if fan_out and not reply.cached:
+                label += f" in {completion.latency:.1f}s"
+
+            # Stored before the results are written, the actions get its handle
+            handle = answers.store(answer)
 
-            for row in self.prompts:
-                if row["Key Word"] == self.default_system_prompt:
-                    system_message = row["System Message"]
+            self.add_item(
+                title=f"Copy to clipboard{suffix}",
+                subtitle=f"{label}: {short_answer}",
+                method=self.copy_answer,
+                parameters=[handle],
+            )
 
-        if len(prompt_array) == 1:
-            prompt = prompt_array[0]
+            self.add_item(
+                title=f"Open in text editor{suffix}",
+                subtitle=f"{label}: {short_answer}",
+                method=self.open_in_editor,
+                parameters=[reply.filename, handle],
+            )
 
-        logging.debug(
-            f"""
-        Prompt: {prompt}
-        Prompt keyword: {prompt_keyword}
-        System message: {system_message}
+    def settings_int(self, key: str, default: int) -> int:
         """
-        )
+        Read a numeric setting. Flow stores input fields as strings.
+        """
+        try:
+            return int(self.settings.get(key) or default)
+        except (TypeError, ValueError):
+            logging.warning(f"Invalid value for setting {key}, using {default}")
+            return default
 
-        return prompt, prompt_keyword, system_message
+    def describe_tokens(self, count: int, model: Optional[str] = None) -> str:
+        """
+        Token count of a prompt with its estimated price, for the subtitles.
+        """
+        description = f"~{count} tokens"
+        cost = tokens.input_cost(model or self.model, count)
+        if cost is not None:
+            description += f", ~${cost:.4f}" if cost >= 0.0001 else ", <$0.0001"
+        return description
 
     def ellipsis(self, string: str, length: int):
         string = string.split("\n", 1)[0]
         return string[: length - 3] + "..." if len(string) > length else string
 
     def copy_answer(self, answer: str) -> None:
-        """
-        Copy answer to the clipboard.
-        """
-        pyperclip.copy(answer)
+        actions.copy_answer(answer)
 
     def open_in_editor(self, filename: Optional[str], answer: Optional[str]) -> None:
-        """
-        Open the answer in the default text editor. If no filename is given,
-        the conversation will be written to a new text file and opened.
-        """
-        if filename:
-            webbrowser.open(filename)
-            return
-
-        if answer:
-            temp_file = "temp_text.txt"
-            with open(temp_file, "w", encoding="utf-8") as f:
-                f.write(answer)
-            webbrowser.open(temp_file)
-            return
+        actions.open_in_editor(filename, answer)
 
     def display_answer(self, answer: str) -> None:
         """
@@ -246,10 +249,108 @@ class ChatGPT(Flox):
         )
 
     def open_plugin_folder(self) -> None:
-        webbrowser.open(os.getcwd())
+        actions.open_plugin_folder()
+
+    def new_thread(self, keyword: str) -> None:
+        actions.new_thread(keyword)
 
-    def __exit__(self, exc_type, exc_value, exc_traceback):
-        self.csv_file.close()
+    @cached_property
+    def speculation(self) -> Speculation:
+        return Speculation(self.engine.config.state_dir)
+
+    def speculate(self) -> None:
+        """
+        Run the speculator, which main.py --speculate starts in the background.
+        """
+        if self.speculative_delay > 0:
+            self.speculation.serve(
+                self.engine, self.speculative_delay, self.speculative_daily_tokens
+            )
+
+    @cached_property
+    def logger(self):
+        """
+        Only attach the plugin log handler once, since a resident worker
+        creates a new instance for every request.
+        """
+        root = logging.getLogger("")
+        logfile = os.path.abspath(self.logfile)
+        for handler in root.handlers:
+            if getattr(handler, "baseFilename", None) == logfile:
+                return root
+        return Flox.logger.func(self)
+
+    def run(self, debug=None):
+        """
+        Same as Launcher.run, but the request and the output can be supplied
+        by the resident worker instead of sys.argv and stdout. The results are
+        written before the conversation and the cache are saved.
+        """
+        if debug:
+            self._debug = debug
+        self.rpc_request = {"method": "query", "parameters": [""]}
+        if self._argv is not None:
+            self.rpc_request = json.loads(self._argv)
+        elif len(sys.argv) > 1:
+            self.rpc_request = json.loads(sys.argv[1])
+        if "settings" in self.rpc_request.keys():
+            self._settings = self.rpc_request["settings"]
+            self.logger.debug("Loaded settings from RPC request")
+        if not self._debug:
+            self._debug = self.settings.get("debug", False)
+        if self._debug:
+            self.logger_level("debug")
+        self.logger.debug(f"Request:\n{json.dumps(self.rpc_request, indent=4)}")
+        self.logger.debug(f"Params: {self.rpc_request.get('parameters')}")
+        request_method_name = self.rpc_request.get("method")
+        if request_method_name in ("query", "context_menu"):
+            request_method_name = f"_{request_method_name}"
+
+        request_parameters = self.rpc_request.get("parameters")
+
+        request_method = getattr(self, request_method_name)
+        try:
+            results = request_method(*request_parameters) or self._results
+        except Exception as e:
+            self.logger.exception(e)
+            results = self.exception(e) or self._results
+        ms = int((time.time() - self._start) * 1000)
+        self.logger.debug(f"{'#' * 10} Total time: {ms}ms {'#' * 10}")
+        if request_method_name in ("_query", "_context_menu"):
+            results = {"result": results}
+            if (
+                self._settings != self.rpc_request.get("Settings")
+                and self._settings is not None
+            ):
+                results["SettingsChange"] = self.settings
+
+            self.write_output(json.dumps(results, ensure_ascii=False))
+
+        # The resident worker replies first, the writes finish on their own
+        engine = getattr(self, "engine", None)
+        if self._output is None and engine and engine.write_behind.pending:
+            self.release_output()
+            engine.write_behind.wait()
+
+    def write_output(self, text: str) -> None:
+        if self._output is not None:
+            self._output.append(text + "\n")
+        else:
+            sys.stdout.buffer.write(f"{text}\n".encode("utf-8"))
+            sys.stdout.flush()
+
+    @staticmethod
+    def release_output() -> None:
+        """
+        Close stdout and stderr, so Flow reads the results without waiting for
+        the process to exit.
+        """
+        sys.stdout.flush()
+        sys.stderr.flush()
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        os.dup2(devnull, sys.stderr.fileno())
+        os.close(devnull)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import logging
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from plugin.locks import FileLock, atomic_write
+from plugin.router import ALPHA, HEALTH_TTL
+
+
+class ModelChoice(NamedTuple):
+    """
+    Model a prompt is sent to, and why, empty when it is the model setting.
+    """
+
+    model: str
+    reason: str = ""
+
+
+def parse_size_rules(text: str) -> List[Tuple[int, str]]:
+    """
+    Parse comma separated tokens=model pairs, like "500=gpt-4o-mini", into
+    (tokens, model) tuples, smallest first. Invalid pairs are skipped.
+    """
+    rules = []
+    for rule in (text or "").split(","):
+        size, _, model = rule.partition("=")
+        try:
+            rules.append((int(size), model.strip()))
+        except ValueError:
+            if rule.strip():
+                logging.warning(f"Invalid model size rule: {rule}")
+    return sorted(rule for rule in rules if rule[1])
+
+
+class ModelRouter:
+    """
+    Chooses the model for each prompt.
+
+    A model set for the keyword in system_messages.csv comes first. Other
+    prompts go to the model of the smallest size rule they fit in, or to the
+    model setting. When the moving average of the response time of that model
+    is above latency_limit, fast_model is used instead until the average is
+    forgotten, so the model is measured again. The response times are kept in
+    a state file shared by all plugin processes.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        path: str,
+        size_rules: List[Tuple[int, str]] = (),
+        fast_model: str = "",
+        latency_limit: float = 0,
+    ):
+        self.model = model
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self.size_rules = size_rules
+        self.fast_model = fast_model
+        self.latency_limit = latency_limit
+
+    def choose(self, prompt_tokens: int = 0, keyword_model: str = "") -> ModelChoice:
+        if keyword_model:
+            choice = ModelChoice(keyword_model, "set for the keyword")
+        else:
+            choice = ModelChoice(self.model)
+            for size, model in self.size_rules:
+                if prompt_tokens <= size:
+                    choice = ModelChoice(model, f"prompt of ~{prompt_tokens} tokens")
+                    break
+
+        if self.fast_model and self.latency_limit > 0:
+            latency = self.latency(choice.model)
+            if latency is not None and latency > self.latency_limit:
+                if self.fast_model != choice.model:
+                    reason = f"{choice.model} takes {latency:.1f}s"
+                    choice = ModelChoice(self.fast_model, reason)
+        return choice
+
+    def latency(self, model: str) -> Optional[float]:
+        stats = self._load().get(model)
+        if not stats or time.time() - stats["updated"] > HEALTH_TTL:
+            return None
+        return stats["latency"]
+
+    def record(self, model: str, latency: float) -> None:
+        """
+        Add the time until the response of a successful request started.
+        """
+        if not self.fast_model or self.latency_limit <= 0:
+            return
+        try:
+            with FileLock(self.lock_path):
+                models = self._load()
+                stats = models.get(model)
+                now = time.time()
+                if stats and now - stats["updated"] <= HEALTH_TTL:
+                    latency = (1 - ALPHA) * stats["latency"] + ALPHA * latency
+                models[model] = {"latency": latency, "updated": now}
+                with atomic_write(self.path) as f:
+                    json.dump(models, f)
+        except OSError as e:
+            logging.warning(f"Unable to save the model response times: {e}")
+
+    def _load(self) -> Dict[str, dict]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
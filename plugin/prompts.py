@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import marshal
+import logging
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from plugin.locks import atomic_write
+
+# Tables that were already loaded, kept for the lifetime of a resident worker
+_tables: Dict[str, Tuple[Tuple[int, int], "PromptTable"]] = {}
+
+
+def _number(minimum: float, maximum: float) -> Callable[[str], float]:
+    def parse(value: str) -> float:
+        number = float(value)
+        if not minimum <= number <= maximum:
+            raise ValueError(f"{value} is not between {minimum} and {maximum}")
+        return number
+
+    return parse
+
+
+def _positive_int(value: str) -> int:
+    number = int(value)
+    if number <= 0:
+        raise ValueError(f"{value} is not a positive number")
+    return number
+
+
+def _stop(value: str) -> Any:
+    """
+    A stop sequence, or a JSON list of up to 4 of them.
+    """
+    if not value.startswith("["):
+        return value
+    stops = json.loads(value)
+    if not 1 <= len(stops) <= 4 or not all(isinstance(s, str) for s in stops):
+        raise ValueError("expected a list of 1 to 4 strings")
+    return stops
+
+
+def _response_format(value: str) -> dict:
+    """
+    A response format type, like json_object, or a JSON object.
+    """
+    if value.startswith("{"):
+        response_format = json.loads(value)
+        if not isinstance(response_format.get("type"), str):
+            raise ValueError("the object has no type")
+        return response_format
+    return {"type": value}
+
+
+# Optional columns of system_messages.csv that are added to the request body
+GENERATION_PARAMS: Dict[str, Callable[[str], Any]] = {
+    "max_tokens": _positive_int,
+    "temperature": _number(0, 2),
+    "top_p": _number(0, 1),
+    "stop": _stop,
+    "seed": int,
+    "n": _positive_int,
+    "response_format": _response_format,
+}
+
+
+def parse_params(row: dict) -> dict:
+    """
+    Validated generation parameters of a row. Empty columns are left out, and
+    invalid values are logged and left out.
+    """
+    params = {}
+    for name, parse in GENERATION_PARAMS.items():
+        value = (row.get(name) or "").strip()
+        if not value:
+            continue
+        try:
+            params[name] = parse(value)
+        except (ValueError, TypeError, AttributeError) as e:
+            logging.error(f"Invalid {name} for keyword {row.get('Key Word')}: {e}")
+    return params
+
+
+class PromptTable:
+    """
+    System prompts from system_messages.csv, indexed by keyword.
+
+    The parsed table is compiled to a cache file and reused until the size or
+    modification time of the CSV file changes, so most calls load the prompts
+    with a single read and no CSV parsing. The generation parameters of every
+    keyword are validated when the table is compiled.
+    """
+
+    def __init__(self, rows: Dict[str, dict], params: Dict[str, dict]):
+        self.rows = rows
+        self._params = params
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def get(self, keyword: str) -> Optional[dict]:
+        return self.rows.get(keyword)
+
+    def params(self, keyword: str) -> dict:
+        """
+        Generation parameters for the request body of the keyword.
+        """
+        return self._params.get(keyword, {})
+
+    @classmethod
+    def load(cls, path: str, cache_path: str) -> Optional["PromptTable"]:
+        """
+        Load the table for the CSV file at path. Returns None when the file
+        does not exist.
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            logging.error(f"Unable to open {path}")
+            return None
+        source = (stat.st_mtime_ns, stat.st_size)
+
+        loaded = _tables.get(path)
+        if loaded and loaded[0] == source:
+            return loaded[1]
+
+        compiled = cls._read_compiled(cache_path, source)
+        if compiled is None:
+            compiled = cls._compile(path, cache_path, source)
+
+        table = cls(*compiled)
+        _tables[path] = (source, table)
+        return table
+
+    @staticmethod
+    def _read_compiled(
+        cache_path: str, source: Tuple[int, int]
+    ) -> Optional[Tuple[Dict[str, dict], Dict[str, dict]]]:
+        try:
+            with open(cache_path, "rb") as f:
+                compiled_source, rows, params = marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if tuple(compiled_source) != source:
+            return None
+        return rows, params
+
+    @staticmethod
+    def _compile(
+        path: str, cache_path: str, source: Tuple[int, int]
+    ) -> Tuple[Dict[str, dict], Dict[str, dict]]:
+        import io
+        import csv
+
+        with open(path, encoding="utf-8", mode="r") as csv_file:
+            content = csv_file.read()
+
+        rows = {}
+        params = {}
+        for row in csv.DictReader(io.StringIO(content), delimiter=";"):
+            logging.debug(f"Found prompt: {row}")
+            if row.get("Key Word") is not None:
+                rows[row["Key Word"]] = row
+                params[row["Key Word"]] = parse_params(row)
+
+        try:
+            with atomic_write(cache_path, "wb") as f:
+                f.write(marshal.dumps((source, rows, params)))
+        except OSError as e:
+            logging.warning(f"Unable to write the compiled prompts: {e}")
+        return rows, params
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+import re
+import json
+import time
+import logging
+from typing import Mapping, Optional
+
+from plugin.locks import FileLock, atomic_write
+
+# Durations in the x-ratelimit-reset-* headers, such as "20ms", "1s" or "6m0s"
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """
+    Seconds in a duration like "6m0s", or None when it cannot be parsed.
+    """
+    if not value:
+        return None
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+
+class RateLimiter:
+    """
+    Token buckets for requests and tokens per minute, shared by every plugin
+    process through a state file.
+
+    Before a request is sent, one request and its estimated tokens are taken
+    from the buckets, waiting for them to refill when needed. The rate limit
+    headers of the responses pause all processes until the limit resets once
+    the server reports that nothing is left.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        requests_per_minute: int = 0,
+        tokens_per_minute: int = 0,
+        max_wait: float = 30,
+    ):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_wait = max_wait
+
+    def acquire(self, tokens: int = 0, max_wait: Optional[float] = None) -> float:
+        """
+        Wait until the request can be sent and return the time waited. After
+        max_wait the request is let through, and the server decides. Without
+        limits of its own, only a pause reported by the server is waited for,
+        and the state file is only read.
+        """
+        if max_wait is None:
+            max_wait = self.max_wait
+        limited = self.requests_per_minute > 0 or self.tokens_per_minute > 0
+        start = time.monotonic()
+        while True:
+            if limited:
+                with FileLock(self.lock_path):
+                    state = self._load()
+                    wait = self._take(state, tokens)
+                    self._save(state)
+            else:
+                wait = self.paused()
+            waited = time.monotonic() - start
+            if wait <= 0:
+                return waited
+            if waited + wait > max_wait:
+                logging.warning(
+                    f"Rate limit would delay the request by {wait:.1f}s more, "
+                    "sending it anyway"
+                )
+                return waited
+            logging.debug(f"Rate limited, waiting {wait:.2f}s")
+            time.sleep(wait)
+
+    def paused(self) -> float:
+        """
+        Seconds left until the limit reported by the server resets.
+        """
+        return max(self._load().get("paused_until", 0) - time.time(), 0.0)
+
+    def update(self, headers: Mapping[str, str], status_code: int = 200) -> None:
+        """
+        Pause every process until the limit resets when the response reports
+        that the requests or tokens are used up, or was rate limited.
+        """
+        pause = 0.0
+        for kind in ("requests", "tokens"):
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+            if remaining is not None and reset and remaining.strip() == "0":
+                pause = max(pause, reset)
+        if status_code == 429:
+            retry_after = headers.get("retry-after")
+            try:
+                pause = max(pause, float(retry_after))
+            except (TypeError, ValueError):
+                pause = max(pause, 1.0)
+        if pause <= 0:
+            return
+
+        with FileLock(self.lock_path):
+            state = self._load()
+            state["paused_until"] = max(
+                state.get("paused_until", 0), time.time() + pause
+            )
+            self._save(state)
+        logging.debug(f"Rate limit reached, pausing requests for {pause:.2f}s")
+
+    def _take(self, state: dict, tokens: int) -> float:
+        """
+        Refill the buckets and take one request and tokens from them. Returns
+        how long to wait instead when they do not hold enough.
+        """
+        now = time.time()
+        paused = state.get("paused_until", 0) - now
+        if paused > 0:
+            return paused
+
+        elapsed = max(now - state.get("updated", now), 0)
+        state["updated"] = now
+        wait = 0.0
+        buckets = (
+            ("requests", self.requests_per_minute, 1),
+            ("tokens", self.tokens_per_minute, min(tokens, self.tokens_per_minute)),
+        )
+        for name, per_minute, needed in buckets:
+            if per_minute <= 0:
+                continue
+            level = min(
+                state.get(name, per_minute) + elapsed * per_minute / 60, per_minute
+            )
+            state[name] = level
+            if level < needed:
+                wait = max(wait, (needed - level) * 60 / per_minute)
+        if wait > 0:
+            return wait
+
+        for name, per_minute, needed in buckets:
+            if per_minute > 0:
+                state[name] -= needed
+        return 0.0
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, state: dict) -> None:
+        try:
+            with atomic_write(self.path) as f:
+                json.dump(state, f)
+        except OSError as e:
+            logging.warning(f"Unable to save the rate limit state: {e}")
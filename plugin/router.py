@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from plugin.locks import FileLock, atomic_write
+
+# Weight of a new sample in the moving averages
+ALPHA = 0.3
+
+# Seconds of latency a 100% error rate counts as when ranking endpoints
+ERROR_PENALTY = 10
+
+# Consecutive failures after which an endpoint is skipped, and for how long
+MAX_FAILURES = 3
+DOWN_SECONDS = 30
+
+# Health older than this is forgotten, so the endpoints are measured again
+HEALTH_TTL = 10 * 60
+
+# Latencies kept per endpoint for percentiles, and how many are needed
+MAX_SAMPLES = 50
+MIN_SAMPLES = 10
+
+
+@dataclass
+class Endpoint:
+    """
+    OpenAI-compatible chat completions endpoint. models maps the configured
+    model names to the names this endpoint uses for them.
+    """
+
+    url: str
+    api_key: str
+    models: Dict[str, str] = field(default_factory=dict)
+
+    def model_for(self, model: str) -> str:
+        return self.models.get(model, model)
+
+
+def parse_endpoints(text: str, api_key: str) -> List[Endpoint]:
+    """
+    Parse one endpoint per line: the URL, optionally followed by its API key
+    and by model=name pairs. Endpoints without a key use api_key. Empty lines
+    and lines starting with # are skipped.
+    """
+    endpoints = []
+    for line in (text or "").splitlines():
+        parts = line.split()
+        if not parts or parts[0].startswith("#"):
+            continue
+        endpoint = Endpoint(parts[0], api_key)
+        for part in parts[1:]:
+            if "=" in part:
+                model, _, name = part.partition("=")
+                endpoint.models[model] = name
+            else:
+                endpoint.api_key = part
+        endpoints.append(endpoint)
+    return endpoints
+
+
+class Router:
+    """
+    Chooses the endpoint to send a request to.
+
+    The moving average of the latency and error rate of every endpoint is kept
+    in a state file, so it carries over between plugin processes. Endpoints
+    are tried from the healthiest to the least healthy. An endpoint that
+    failed several times in a row is skipped for a while, unless every
+    endpoint is failing. The first endpoint is preferred while there is no
+    recent measurement of it.
+    """
+
+    def __init__(self, endpoints: List[Endpoint], path: str):
+        self.endpoints = endpoints
+        self.path = path
+        self.lock_path = f"{path}.lock"
+
+    def order(self) -> List[Endpoint]:
+        if len(self.endpoints) == 1:
+            return list(self.endpoints)
+        health = self._load()
+        now = time.time()
+
+        def rank(item):
+            index, endpoint = item
+            stats = health.get(endpoint.url)
+            if not stats or now - stats.get("updated", 0) > HEALTH_TTL:
+                return (False, 0.0 if index == 0 else float("inf"), index)
+            down = stats.get("down_until", 0) > now
+            score = stats["latency"] + ERROR_PENALTY * stats["errors"]
+            return (down, score, index)
+
+        return [endpoint for _, endpoint in sorted(enumerate(self.endpoints), key=rank)]
+
+    def record(self, endpoint: Endpoint, latency: float, ok: bool) -> None:
+        """
+        Add the outcome of a request. latency, the time until the response
+        started, is only used when it succeeded.
+        """
+        try:
+            with FileLock(self.lock_path):
+                health = self._load()
+                stats = health.get(endpoint.url)
+                now = time.time()
+                samples = stats.get("samples", []) if stats else []
+                if not stats or now - stats.get("updated", 0) > HEALTH_TTL:
+                    stats = {"latency": latency, "errors": 0.0, "failures": 0}
+                stats["updated"] = now
+                stats["errors"] = (1 - ALPHA) * stats["errors"] + (0 if ok else ALPHA)
+                if ok:
+                    stats["latency"] = (1 - ALPHA) * stats["latency"] + ALPHA * latency
+                    stats["failures"] = 0
+                    stats.pop("down_until", None)
+                    samples = (samples + [round(latency, 3)])[-MAX_SAMPLES:]
+                else:
+                    stats["failures"] += 1
+                    if stats["failures"] >= MAX_FAILURES:
+                        stats["down_until"] = now + DOWN_SECONDS
+                stats["samples"] = samples
+                health[endpoint.url] = stats
+                self._save(health)
+        except OSError as e:
+            logging.warning(f"Unable to save the endpoint health: {e}")
+
+    def percentile(self, endpoint: Endpoint, percent: float) -> Optional[float]:
+        """
+        Latency of the recent successful requests to the endpoint below which
+        the given percentage falls, or None while there are too few of them.
+        The samples outlive the moving averages.
+        """
+        samples = sorted(self._load().get(endpoint.url, {}).get("samples", []))
+        if len(samples) < MIN_SAMPLES:
+            return None
+        index = min(int(len(samples) * percent / 100), len(samples) - 1)
+        return samples[index]
+
+    def health(self) -> Dict[str, dict]:
+        return self._load()
+
+    def _load(self) -> Dict[str, dict]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, health: Dict[str, dict]) -> None:
+        with atomic_write(self.path) as f:
+            json.dump(health, f)
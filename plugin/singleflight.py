@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import logging
+from typing import Optional, Tuple
+
+from plugin.locks import FileLock, atomic_write
+
+# Result files are kept this long for processes that are still waiting
+RESULT_TTL = 5 * 60
+
+# Lock files of requests that were not made for this long are removed
+LOCK_TTL = 60 * 60
+
+
+class Flight:
+    """
+    One request to the API, shared by all processes that make it at the same
+    time.
+
+    The first process takes the lock for the request hash and becomes the
+    leader: it sends the request and publishes the outcome to a result file
+    before releasing the lock. Processes making the same request in the
+    meantime wait for the lock and use the published result instead of
+    sending the request again.
+    """
+
+    def __init__(self, directory: str, key: str):
+        self.directory = directory
+        self.lock = FileLock(os.path.join(directory, f"{key}.lock"))
+        self.result_path = os.path.join(directory, f"{key}.json")
+
+    def lead_or_wait(self, timeout: float) -> Tuple[bool, Optional[dict]]:
+        """
+        Become the leader, holding the lock, or wait for the leader to finish.
+        Returns whether this process leads, and the result of the leader. A
+        waiting process takes over when the leader left no usable result. Both
+        are False and None when the wait timed out.
+        """
+        if self.lock.acquire(blocking=False):
+            self._touch()
+            return True, None
+
+        logging.debug("Waiting for an identical request in another process")
+        # The leader touched the lock when it started, and keeps the lock until
+        # its result is in the cache, so any result published since is its own
+        started = self._led_since()
+        if not self.lock.acquire(timeout=timeout):
+            return False, None
+        result = self._read()
+        if result and result.get("finished", 0) >= started:
+            self.lock.release()
+            return False, result
+        self._touch()
+        return True, None
+
+    def publish(self, result: dict) -> None:
+        result = dict(result, finished=time.time())
+        try:
+            with atomic_write(self.result_path) as f:
+                json.dump(result, f)
+        except OSError as e:
+            logging.error(f"Unable to publish the result of a request: {e}")
+
+    def release(self) -> None:
+        self.lock.release()
+        self._clean()
+
+    def _read(self) -> Optional[dict]:
+        try:
+            with open(self.result_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _led_since(self) -> float:
+        try:
+            return min(os.stat(self.lock.path).st_mtime, time.time())
+        except OSError:
+            return time.time()
+
+    def _touch(self) -> None:
+        try:
+            os.utime(self.lock.path)
+        except OSError:
+            pass
+
+    def _clean(self) -> None:
+        """
+        Remove results nobody can be waiting for anymore, and the lock files
+        of requests that were not made for a long time.
+        """
+        now = time.time()
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    ttl = LOCK_TTL if entry.name.endswith(".lock") else RESULT_TTL
+                    if now - entry.stat().st_mtime > ttl:
+                        os.remove(entry.path)
+        except OSError:
+            pass
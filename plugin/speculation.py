@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+"""
+Opt-in speculative sending.
+
+While the user types, the typing path records the query without the prompt
+stop. A detached speculator process waits until the query has not changed
+for the configured pause, then sends it in the background. The answer ends
+up in the response cache under the same key as the real query, so typing
+the prompt stop afterwards is answered from the cache. Any edit cancels the
+speculative request in flight, and speculative prompts never touch the
+conversation files or the context threads.
+
+The tokens spent on speculation are counted per day and capped.
+"""
+
+import os
+import json
+import time
+import logging
+from datetime import date
+from typing import TYPE_CHECKING, Optional, Tuple
+
+from plugin import tokens
+from plugin.generation import Generation
+from plugin.locks import FileLock, atomic_write
+
+if TYPE_CHECKING:
+    from plugin.engine import Engine
+
+# Shorter queries are not worth sending speculatively
+MIN_PROMPT_CHARS = 10
+
+# How often the speculator checks for changes, and when it exits when idle
+POLL_INTERVAL = 0.05
+IDLE_TIMEOUT = 120
+
+
+class Speculation:
+    def __init__(self, state_dir: str):
+        self.directory = os.path.join(state_dir, "speculation")
+        self.request_path = os.path.join(self.directory, "request.json")
+        self.budget_path = os.path.join(self.directory, "budget.json")
+        self.lock_path = os.path.join(self.directory, "speculator.lock")
+        self.generation = Generation(self.directory)
+
+    @staticmethod
+    def normalize(query: str, prompt_stop: str) -> str:
+        """
+        The query without the start of a prompt stop that is being typed, so
+        typing the prompt stop does not count as an edit.
+        """
+        query = query.strip()
+        for length in range(len(prompt_stop) - 1, 0, -1):
+            if query.endswith(prompt_stop[:length]):
+                return query[:-length].rstrip()
+        return query
+
+    def note(self, query: str, prompt_stop: str) -> None:
+        """
+        Record the query being typed, cancel speculation on older text and
+        make sure a speculator is running. Called from the typing path.
+        """
+        text = self.normalize(query, prompt_stop)
+        if text == self.read_request()[0]:
+            return
+        self.write_request(text)
+        self.generation.bump_if_inflight()
+        if len(text) >= MIN_PROMPT_CHARS and not self.running():
+            from plugin import worker
+
+            worker.start_detached("--speculate")
+
+    def running(self) -> bool:
+        lock = FileLock(self.lock_path)
+        if not lock.acquire(blocking=False):
+            return True
+        lock.release()
+        return False
+
+    def read_request(self) -> Tuple[str, float]:
+        """
+        Query being typed and when it was last changed.
+        """
+        try:
+            with open(self.request_path, "r", encoding="utf-8") as f:
+                return json.load(f)["query"], os.fstat(f.fileno()).st_mtime
+        except (OSError, ValueError, KeyError):
+            return "", 0.0
+
+    def write_request(self, text: str) -> None:
+        with atomic_write(self.request_path) as f:
+            json.dump({"query": text}, f)
+
+    def serve(self, engine: "Engine", delay: float, daily_tokens: int) -> None:
+        """
+        Run the speculator until nothing was typed for IDLE_TIMEOUT seconds.
+        Only one speculator runs at a time.
+        """
+        lock = FileLock(self.lock_path)
+        if not lock.acquire(blocking=False):
+            return
+
+        # Edits cancel speculative requests, never the real ones
+        engine.generation = self.generation
+        sent: Optional[str] = None
+        try:
+            while True:
+                text, changed = self.read_request()
+                idle = time.time() - changed
+                if idle > IDLE_TIMEOUT:
+                    break
+                if idle >= delay and text != sent:
+                    sent = text
+                    if len(text) >= MIN_PROMPT_CHARS:
+                        self.speculate(engine, text, daily_tokens)
+                time.sleep(POLL_INTERVAL)
+        finally:
+            lock.release()
+
+    def speculate(self, engine: "Engine", text: str, daily_tokens: int) -> None:
+        config = engine.config
+        for query in engine.split_queries(f"{text}{config.prompt_stop}"):
+            prompt, keyword, system_message = engine.split_prompt(query)
+            if config.cache_ttl <= 0 or keyword in config.cache_exclude:
+                continue
+
+            # Counted like the prompts that are sent, including the thread
+            history = []
+            if config.thread_turns > 0:
+                history = engine.threads.recent(
+                    keyword, config.thread_tokens, config.model
+                )
+            prompt_tokens = engine.fit_context(prompt, system_message, history)[1]
+            spent = self.spent()
+
+            # The answers may use what is left of the budget, and no more
+            params = engine.prompts.params(keyword) if engine.prompts else {}
+            answer_tokens = (daily_tokens - spent - prompt_tokens) // params.get("n", 1)
+            if answer_tokens <= 0:
+                logging.info(
+                    f"Not sending speculatively, {spent} of {daily_tokens} "
+                    "tokens were spent today"
+                )
+                return
+
+            generation = self.generation.begin()
+            try:
+                reply = engine.ask(
+                    query, generation, save=False, max_tokens=answer_tokens
+                )
+            finally:
+                self.generation.end(generation)
+            if reply.cached:
+                continue
+
+            completion = reply.completion
+            cost = reply.prompt_tokens
+            for answer in completion.choices or [completion.answer]:
+                cost += tokens.count(answer, reply.model)
+            self.spend(cost)
+            logging.debug(
+                f"Sent '{keyword}' prompt speculatively, cancelled: "
+                f"{reply.completion.cancelled}"
+            )
+
+    def spent(self) -> int:
+        """
+        Tokens spent on speculation today.
+        """
+        try:
+            with open(self.budget_path, "r") as f:
+                budget = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        if budget.get("day") != date.today().isoformat():
+            return 0
+        return budget.get("tokens", 0)
+
+    def spend(self, count: int) -> None:
+        budget = {"day": date.today().isoformat(), "tokens": self.spent() + count}
+        with atomic_write(self.budget_path) as f:
+            json.dump(budget, f)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import logging
+from typing import List, Tuple
+
+from plugin import tokens
+from plugin.locks import FileLock, atomic_write
+
+Turn = Tuple[str, str]
+
+
+class ThreadStore:
+    """
+    Recent turns of the conversation for each keyword, sent along with new
+    prompts as context.
+
+    Every thread is a small ring buffer file holding the last max_turns
+    prompts and answers, so loading the context never means parsing the
+    conversation files, which keep growing.
+    """
+
+    def __init__(self, directory: str, max_turns: int = 10):
+        self.directory = directory
+        self.max_turns = max_turns
+
+    def path(self, keyword: str) -> str:
+        return os.path.join(self.directory, f"{keyword}.json")
+
+    def turns(self, keyword: str) -> List[Turn]:
+        """
+        Turns of the thread, oldest first.
+        """
+        try:
+            with open(self.path(keyword), "r", encoding="utf-8") as f:
+                return [tuple(turn) for turn in json.load(f)]
+        except (OSError, ValueError, TypeError):
+            return []
+
+    def recent(self, keyword: str, budget: int, model: str) -> List[Turn]:
+        """
+        The most recent turns that fit in budget tokens, oldest first.
+        Older turns are left out.
+        """
+        selected: List[Turn] = []
+        for prompt, answer in reversed(self.turns(keyword)):
+            cost = tokens.count(prompt, model) + tokens.count(answer, model)
+            cost += 2 * tokens.TOKENS_PER_MESSAGE
+            if cost > budget:
+                break
+            budget -= cost
+            selected.append((prompt, answer))
+        selected.reverse()
+        return selected
+
+    def append(self, keyword: str, prompt: str, answer: str) -> None:
+        path = self.path(keyword)
+        try:
+            with FileLock(f"{path}.lock"):
+                turns = self.turns(keyword) + [(prompt, answer)]
+                with atomic_write(path) as f:
+                    json.dump(turns[-self.max_turns :], f)
+        except OSError as e:
+            logging.error(f"Unable to save the thread for {keyword}: {e}")
+
+    def clear(self, keyword: str) -> None:
+        """
+        Start a new thread. The conversation files are kept.
+        """
+        path = self.path(keyword)
+        with FileLock(f"{path}.lock"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
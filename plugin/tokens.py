@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local token counting.
+
+When tiktoken is installed and the encoding of the model is on disk, counts
+are exact for texts up to EXACT_MAX_CHARS. Encodings are never downloaded,
+so counting does not wait for the network. Otherwise, and for longer texts,
+they are estimated from the number of ASCII and non-ASCII characters, which
+takes a few milliseconds even for texts of several megabytes.
+"""
+
+import os
+import hashlib
+import logging
+from typing import Dict, Optional, Tuple
+
+# Longer texts are estimated, as exact counting would take too long
+EXACT_MAX_CHARS = 200_000
+
+# Tokens added by the chat format for every message, and for the reply
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+# Room left for the answer when the prompt is fitted into the context window
+ANSWER_RESERVE = 1024
+
+# Context window of the known models, matched on the longest prefix
+CONTEXT_LIMITS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-3.5-turbo-instruct": 4096,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-turbo": 128000,
+    "gpt-4-1106": 128000,
+    "gpt-4-0125": 128000,
+    "gpt-4o": 128000,
+    "gpt-4.1": 1047576,
+}
+
+# US dollars per million input tokens, matched on the longest prefix
+INPUT_PRICES = {
+    "gpt-3.5-turbo": 0.5,
+    "gpt-4": 30.0,
+    "gpt-4-32k": 60.0,
+    "gpt-4-turbo": 10.0,
+    "gpt-4o": 2.5,
+    "gpt-4o-mini": 0.15,
+    "gpt-4.1": 2.0,
+    "gpt-4.1-mini": 0.4,
+}
+
+# Folder tiktoken loads the encodings from, unless TIKTOKEN_CACHE_DIR is set
+ENCODING_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tiktoken_cache"
+)
+
+# Files of the encodings, which tiktoken caches under the SHA-1 of their URL
+ENCODING_URLS = {
+    name: f"https://openaipublic.blob.core.windows.net/encodings/{file}.tiktoken"
+    for name, file in (
+        ("r50k_base", "r50k_base"),
+        ("p50k_base", "p50k_base"),
+        ("p50k_edit", "p50k_base"),
+        ("cl100k_base", "cl100k_base"),
+        ("o200k_base", "o200k_base"),
+    )
+}
+
+# Encodings by model, None when tiktoken or the encoding is not available
+_encodings: Dict[str, Optional[object]] = {}
+
+
+def _lookup(table: Dict[str, float], model: str) -> Optional[float]:
+    matches = [prefix for prefix in table if model.startswith(prefix)]
+    return table[max(matches, key=len)] if matches else None
+
+
+def context_limit(model: str) -> Optional[int]:
+    limit = _lookup(CONTEXT_LIMITS, model)
+    return int(limit) if limit else None
+
+
+def input_cost(model: str, tokens: int) -> Optional[float]:
+    """
+    Estimated price of sending the tokens to the model, in US dollars.
+    """
+    price = _lookup(INPUT_PRICES, model)
+    return None if price is None else tokens * price / 1_000_000
+
+
+def estimate(text: str) -> int:
+    """
+    Estimate the number of tokens without a tokenizer. English text averages
+    about four characters per token, other scripts about one per character.
+    """
+    if text.isascii():
+        non_ascii = 0
+    else:
+        # Every non-ASCII character takes two to four bytes in UTF-8
+        non_ascii = (len(text.encode("utf-8", errors="replace")) - len(text)) // 2
+    return (len(text) - non_ascii + 3) // 4 + non_ascii
+
+
+def _encoding(model: str):
+    if model not in _encodings:
+        _encodings[model] = None
+        try:
+            import tiktoken
+            from tiktoken.model import encoding_name_for_model
+
+            try:
+                name = encoding_name_for_model(model)
+            except KeyError:
+                name = "cl100k_base"
+            if _on_disk(name):
+                _encodings[model] = tiktoken.get_encoding(name)
+            else:
+                logging.debug(f"Estimating token counts, {name} is not on disk")
+        except Exception as e:
+            logging.debug(f"Estimating token counts, tiktoken is unavailable: {e}")
+    return _encodings[model]
+
+
+def _on_disk(name: str) -> bool:
+    """
+    Whether tiktoken can load the encoding without downloading it.
+    """
+    url = ENCODING_URLS.get(name)
+    cache_dir = os.environ.setdefault("TIKTOKEN_CACHE_DIR", ENCODING_DIR)
+    if url is None or not cache_dir:
+        return False
+    key = hashlib.sha1(url.encode()).hexdigest()
+    return os.path.exists(os.path.join(cache_dir, key))
+
+
+def count(text: str, model: str) -> int:
+    """
+    Number of tokens in the text for the model.
+    """
+    encoding = _encoding(model) if len(text) <= EXACT_MAX_CHARS else None
+    if encoding is None:
+        return estimate(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_messages(system_message: str, prompt: str, model: str) -> int:
+    """
+    Number of prompt tokens of a chat request with a system and user message.
+    """
+    return (
+        count(system_message, model)
+        + count(prompt, model)
+        + 2 * TOKENS_PER_MESSAGE
+        + TOKENS_PER_REPLY
+    )
+
+
+def truncate(text: str, tokens: int, model: str) -> Tuple[str, int]:
+    """
+    Shorten the text to about the given number of tokens, keeping the start.
+    Returns the text and its token count.
+    """
+    if tokens <= 0:
+        return "", 0
+    encoding = _encoding(model) if len(text) <= EXACT_MAX_CHARS else None
+    if encoding is not None:
+        encoded = encoding.encode(text, disallowed_special=())
+        return encoding.decode(encoded[:tokens]), min(len(encoded), tokens)
+
+    total = estimate(text)
+    while total > tokens:
+        text = text[: len(text) * tokens // total]
+        total = estimate(text)
+    return text, total
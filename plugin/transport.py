@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+
+import time
+import random
+import socket
+import threading
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import MaxRetryError, ResponseError
+from urllib3.util.retry import Retry
+
+from plugin.ratelimit import parse_duration
+
+_transports: Dict[tuple, "Transport"] = {}
+_transports_lock = threading.Lock()
+
+# Deadline of the request the current thread is sending, on the monotonic clock
+_deadline = threading.local()
+
+# Abort of the request the current thread is sending
+_abort = threading.local()
+
+
+class Abort:
+    """
+    Stops a request that another thread is sending, such as the request that
+    lost a hedged race. Its connection is shut down, so the request fails
+    right away instead of waiting for a response that is no longer needed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connection: Optional[HTTPConnection] = None
+        self.aborted = False
+
+    def attach(self, connection: HTTPConnection) -> None:
+        with self._lock:
+            self._connection = connection
+            if self.aborted:
+                self._shut_down()
+
+    def abort(self) -> None:
+        with self._lock:
+            self.aborted = True
+            self._shut_down()
+
+    def _shut_down(self) -> None:
+        sock = getattr(self._connection, "sock", None)
+        if sock is None:
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class AbortableConnection:
+    """
+    Connection mixin that attaches the connection to the Abort of the
+    request the current thread is sending. New connections attach once they
+    are connected, pooled ones when the request is sent.
+    """
+
+    def connect(self):
+        super().connect()
+        self._attach()
+
+    def request(self, *args, **kwargs):
+        self._attach()
+        return super().request(*args, **kwargs)
+
+    def _attach(self) -> None:
+        abort = getattr(_abort, "value", None)
+        if abort is not None:
+            abort.attach(self)
+
+
+class AbortableHTTPConnection(AbortableConnection, HTTPConnection):
+    pass
+
+
+class AbortableHTTPSConnection(AbortableConnection, HTTPSConnection):
+    pass
+
+
+class AbortableHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = AbortableHTTPConnection
+
+
+class AbortableHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = AbortableHTTPSConnection
+
+
+POOL_CLASSES = {
+    "http": AbortableHTTPConnectionPool,
+    "https": AbortableHTTPSConnectionPool,
+}
+
+
+class AbortableAdapter(HTTPAdapter):
+    """
+    HTTPAdapter whose requests can be stopped with an Abort.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = POOL_CLASSES
+
+    def proxy_manager_for(self, *args, **kwargs):
+        manager = super().proxy_manager_for(*args, **kwargs)
+        manager.pool_classes_by_scheme = POOL_CLASSES
+        return manager
+
+
+class KeepAliveAdapter(AbortableAdapter):
+    """
+    HTTPAdapter that enables TCP keep-alive on its sockets, so idle pooled
+    connections survive between prompts instead of being dropped silently.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        ]
+        super().init_poolmanager(*args, **kwargs)
+
+
+class ApiRetry(Retry):
+    """
+    Retry policy for the API. Rate limited and failed requests are retried
+    with jittered exponential backoff, waiting at least as long as the server
+    asks for with Retry-After or the x-ratelimit-reset-* headers. A request
+    is not retried when the server asks to wait longer than max_wait, or when
+    the wait would run past the deadline of the request.
+    """
+
+    max_wait = 20
+
+    def get_backoff_time(self) -> float:
+        attempts = len(self.history)
+        if attempts == 0 or not self.backoff_factor:
+            return 0
+        backoff = min(self.backoff_factor * (2 ** (attempts - 1)), self.max_wait)
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+    def get_retry_after(self, response) -> Optional[float]:
+        waits = []
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is not None:
+            waits.append(self.parse_retry_after(retry_after))
+        for kind in ("requests", "tokens"):
+            remaining = response.headers.get(f"x-ratelimit-remaining-{kind}")
+            reset = parse_duration(response.headers.get(f"x-ratelimit-reset-{kind}"))
+            if remaining is not None and remaining.strip() == "0" and reset:
+                waits.append(reset)
+        return max(waits) if waits else None
+
+    def sleep(self, response=None) -> None:
+        retry_after = self.get_retry_after(response) if response else None
+        wait = max(retry_after or 0, self.get_backoff_time())
+        remaining = time_left()
+        time.sleep(wait if remaining is None else max(min(wait, remaining), 0))
+
+    def increment(self, method=None, url=None, response=None, *args, **kwargs):
+        wait = self.get_retry_after(response) if response else None
+        if wait is not None and wait > self.max_wait:
+            raise MaxRetryError(
+                kwargs.get("_pool"),
+                url,
+                ResponseError(f"server asked to retry after {wait:.0f}s"),
+            )
+        retry = super().increment(method, url, response, *args, **kwargs)
+
+        remaining = time_left()
+        if remaining is not None and remaining <= max(
+            wait or 0, retry.get_backoff_time()
+        ):
+            raise MaxRetryError(
+                kwargs.get("_pool"),
+                url,
+                kwargs.get("error") or ResponseError("request deadline reached"),
+            )
+        return retry
+
+
+def time_left() -> Optional[float]:
+    """
+    Seconds left before the deadline of the request sent by this thread.
+    """
+    deadline = getattr(_deadline, "value", None)
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def retry_policy(max_retries: int) -> ApiRetry:
+    """
+    Retry connection failures, rate limits and server errors. Errors after
+    the request was sent are not retried, as the prompt may have been billed.
+    """
+    return ApiRetry(
+        total=max_retries,
+        connect=max_retries,
+        read=0,
+        status=max_retries,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=None,
+        raise_on_status=False,
+    )
+
+
+class Transport:
+    """
+    Pooled HTTP session used for every call to the API endpoint. Connections
+    are kept alive and reused, so only the first request pays for the DNS
+    lookup and the TCP and TLS handshakes.
+    """
+
+    def __init__(
+        self, pool_size: int = 4, keep_alive: bool = True, max_retries: int = 3
+    ):
+        self.session = requests.Session()
+        adapter_class = KeepAliveAdapter if keep_alive else AbortableAdapter
+        self.adapter = adapter_class(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=retry_policy(max_retries),
+        )
+        if not keep_alive:
+            self.session.headers["Connection"] = "close"
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+
+    def post(
+        self,
+        url: str,
+        headers: dict,
+        data: str,
+        proxies: Optional[dict] = None,
+        stream: bool = False,
+        timeout=None,
+        deadline: Optional[float] = None,
+        abort: Optional[Abort] = None,
+    ) -> requests.Response:
+        """
+        Send a request. timeout is passed on to requests, and deadline, on the
+        time.monotonic clock, bounds the time spent on retries. abort can stop
+        the request from another thread.
+        """
+        _deadline.value = deadline
+        _abort.value = abort
+        try:
+            return self.session.post(
+                url,
+                headers=headers,
+                data=data,
+                proxies=proxies,
+                stream=stream,
+                timeout=timeout,
+            )
+        finally:
+            _deadline.value = None
+            _abort.value = None
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Number of connections opened and requests sent by the pooled
+        connections that are still alive.
+        """
+        managers = [self.adapter.poolmanager, *self.adapter.proxy_manager.values()]
+        created = 0
+        sent = 0
+        for manager in managers:
+            for key in manager.pools.keys():
+                pool = manager.pools.get(key)
+                if pool is None:
+                    continue
+                created += pool.num_connections
+                sent += pool.num_requests
+        return {
+            "connections_created": created,
+            "connections_reused": max(sent - created, 0),
+            "requests": sent,
+        }
+
+    def close(self) -> None:
+        self.session.close()
+
+
+def get_transport(
+    pool_size: int = 4, keep_alive: bool = True, max_retries: int = 3
+) -> Transport:
+    """
+    Shared transport for the given pool configuration. A resident worker keeps
+    it, and its open connections, for the lifetime of the process.
+    """
+    key = (pool_size, keep_alive, max_retries)
+    with _transports_lock:
+        if key not in _transports:
+            _transports[key] = Transport(pool_size, keep_alive, max_retries)
+        return _transports[key]
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+"""
+Optional resident worker.
+
+Flow Launcher starts a new Python process for every JSON-RPC call. When the
+resident worker is enabled, the first in-process call starts a long-lived
+worker that keeps the interpreter, modules and caches warm. Later calls are
+forwarded to it by main.py over a loopback socket, so they skip the cold start.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+from typing import Optional
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATE_DIR = os.path.join(PLUGIN_DIR, "state")
+INFO_FILE = os.path.join(STATE_DIR, "worker.json")
+SPAWN_FILE = os.path.join(STATE_DIR, "worker.spawn")
+
+CONNECT_TIMEOUT = 0.5
+REPLY_TIMEOUT = 300
+SPAWN_GRACE = 30
+DEFAULT_IDLE_TIMEOUT = 600
+
+
+def fingerprint() -> str:
+    """
+    Version of the plugin code on disk. The worker restarts when it changes.
+    """
+    paths = [
+        os.path.join(PLUGIN_DIR, "plugin.json"),
+        os.path.join(PLUGIN_DIR, "main.py"),
+    ]
+    plugin_folder = os.path.join(PLUGIN_DIR, "plugin")
+    paths += [
+        os.path.join(plugin_folder, name)
+        for name in sorted(os.listdir(plugin_folder))
+        if name.endswith(".py")
+    ]
+    parts = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        parts.append(f"{os.path.basename(path)}:{stat.st_mtime_ns}:{stat.st_size}")
+    return "|".join(parts)
+
+
+def forward(request: str) -> Optional[str]:
+    """
+    Send a JSON-RPC request to the running worker and return its output.
+    Returns None when no worker could handle it, so the caller can fall back
+    to handling the request in-process.
+    """
+    try:
+        with open(INFO_FILE, "r", encoding="utf-8") as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    message = {
+        "token": info.get("token"),
+        "fingerprint": fingerprint(),
+        "request": request,
+    }
+    try:
+        with socket.create_connection(
+            ("127.0.0.1", info["port"]), timeout=CONNECT_TIMEOUT
+        ) as conn:
+            conn.settimeout(REPLY_TIMEOUT)
+            conn.sendall(json.dumps(message).encode("utf-8") + b"\n")
+            conn.shutdown(socket.SHUT_WR)
+            with conn.makefile("rb") as reader:
+                reply = json.loads(reader.read().decode("utf-8"))
+    except (OSError, ValueError, KeyError):
+        return None
+
+    if reply.get("status") != "ok":
+        return None
+    return reply.get("output", "")
+
+
+def spawn() -> None:
+    """
+    Start a detached worker unless one is already running or starting.
+    """
+    os.makedirs(STATE_DIR, exist_ok=True)
+    try:
+        if time.time() - os.path.getmtime(SPAWN_FILE) < SPAWN_GRACE:
+            return
+        os.remove(SPAWN_FILE)
+    except OSError:
+        pass
+    try:
+        os.close(os.open(SPAWN_FILE, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return
+
+    if not start_detached("--worker"):
+        _remove(SPAWN_FILE)
+
+
+def start_detached(flag: str) -> bool:
+    """
+    Start main.py with flag in a detached background process.
+    """
+    import subprocess
+
+    kwargs = {}
+    if os.name == "nt":
+        kwargs["creationflags"] = (
+            subprocess.CREATE_NO_WINDOW | subprocess.DETACHED_PROCESS
+        )
+    else:
+        kwargs["start_new_session"] = True
+    try:
+        subprocess.Popen(
+            [sys.executable, os.path.join(PLUGIN_DIR, "main.py"), flag],
+            cwd=PLUGIN_DIR,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            close_fds=True,
+            **kwargs,
+        )
+    except OSError as e:
+        _log_error(f"Unable to start main.py {flag}: {e}")
+        return False
+    return True
+
+
+def serve(idle_timeout: int = DEFAULT_IDLE_TIMEOUT) -> None:
+    """
+    Run the worker until it has been idle for idle_timeout seconds, the plugin
+    code changes, or the resident worker setting is switched off. The idle
+    timeout is refreshed from the plugin settings on every request.
+    """
+    import secrets
+    import threading
+
+    from plugin.main import ChatGPT
+
+    version = fingerprint()
+    token = secrets.token_hex(16)
+    state = {
+        "last_request": time.time(),
+        "idle_timeout": idle_timeout,
+        "stop": False,
+    }
+    threads = []
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(16)
+    server.settimeout(1.0)
+    _write_info({"port": server.getsockname()[1], "token": token, "pid": os.getpid()})
+    _remove(SPAWN_FILE)
+
+    def handle(conn: socket.socket) -> None:
+        with conn:
+            try:
+                conn.settimeout(REPLY_TIMEOUT)
+                with conn.makefile("rb") as reader:
+                    message = json.loads(reader.readline().decode("utf-8"))
+                if message.get("token") != token:
+                    return
+                if message.get("fingerprint") != version:
+                    state["stop"] = True
+                    conn.sendall(json.dumps({"status": "stale"}).encode("utf-8"))
+                    return
+
+                output = []
+                plugin = ChatGPT(argv=message["request"], output=output)
+                if not plugin.settings.get("resident_worker"):
+                    state["stop"] = True
+                state["idle_timeout"] = plugin.worker_idle_timeout
+                del plugin
+
+                reply = {"status": "ok", "output": "".join(output)}
+                conn.sendall(json.dumps(reply).encode("utf-8"))
+            except Exception as e:
+                _log_error(f"Resident worker failed to handle a request: {e}")
+            finally:
+                state["last_request"] = time.time()
+
+    try:
+        while not state["stop"]:
+            if time.time() - state["last_request"] > state["idle_timeout"]:
+                break
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                continue
+            state["last_request"] = time.time()
+            thread = threading.Thread(target=handle, args=(conn,), daemon=True)
+            thread.start()
+            threads = [t for t in threads if t.is_alive()] + [thread]
+    finally:
+        server.close()
+        _remove_info(token)
+        for thread in threads:
+            thread.join(REPLY_TIMEOUT)
+
+
+def _log_error(message: str) -> None:
+    import logging
+
+    logging.error(message)
+
+
+def _write_info(info: dict) -> None:
+    from plugin.locks import atomic_write
+
+    with atomic_write(INFO_FILE) as f:
+        json.dump(info, f)
+
+
+def _remove_info(token: str) -> None:
+    """
+    Remove the info file, unless a newer worker has already replaced it.
+    """
+    try:
+        with open(INFO_FILE, "r", encoding="utf-8") as f:
+            if json.load(f).get("token") != token:
+                return
+    except (OSError, ValueError):
+        return
+    _remove(INFO_FILE)
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
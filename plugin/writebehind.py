@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+import threading
+from collections import deque
+from typing import Callable
+
+
+class WriteBehind:
+    """
+    Persistence work that runs after the results are written.
+
+    Deferred jobs run in order on a background thread, so the conversation,
+    the cache and the statistics are saved while Flow already shows the
+    results. The thread is not a daemon, so the process only exits once all
+    jobs are done, and it ends as soon as there is nothing left to do, so a
+    resident worker does not keep one per request. A failing job is logged
+    and does not stop the jobs after it. When disabled, jobs run right away.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._jobs: deque = deque()
+        self._running = False
+        self._idle = threading.Condition()
+
+    @property
+    def pending(self) -> bool:
+        with self._idle:
+            return self._running
+
+    def defer(self, job: Callable, *args) -> None:
+        if not self.enabled:
+            self._run(job, args)
+            return
+        with self._idle:
+            self._jobs.append((job, args))
+            if not self._running:
+                self._running = True
+                threading.Thread(target=self._drain, name="write-behind").start()
+
+    def wait(self) -> None:
+        """
+        Wait until all jobs deferred so far are done.
+        """
+        start = time.time()
+        with self._idle:
+            if not self._running:
+                return
+            self._idle.wait_for(lambda: not self._running)
+        logging.debug(f"Deferred writes done in {int((time.time() - start) * 1000)}ms")
+
+    def _drain(self) -> None:
+        while True:
+            with self._idle:
+                if not self._jobs:
+                    self._running = False
+                    self._idle.notify_all()
+                    return
+                job, args = self._jobs.popleft()
+            self._run(job, args)
+
+    @staticmethod
+    def _run(job: Callable, args: tuple) -> None:
+        try:
+            job(*args)
+        except Exception as e:
+            logging.exception(f"Deferred {getattr(job, '__name__', job)} failed: {e}")